@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Benchmark suite for the named Keyak instances
+#
+# Measures, per instance: StartEngine latency, wrap and unwrap throughput for message sizes from 0 bytes
+# up to --max-size (16 MiB by default), and the cost of metadata-only messages; and the number of
+# KeccakP.apply() calls per second for every permutation used. Every measurement is the best of runs
+# repeated for at least --min-time seconds, on a session forked before each run so that session setup
+# is not measured.
+#
+# Results are written as JSON: {"environment": {...}, "results": {name: {"value", "unit", "better"}}},
+# where better is "lower" or "higher". With --baseline, results are compared to a saved results file
+# and every metric that is worse by more than --threshold (relative) is reported as a regression, in
+# which case the exit status is 1.
+#
+# Example: python benchmark.py -o baseline.json, then later python benchmark.py --baseline baseline.json
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+# NumPy is optional, its version is only recorded in the environment
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from keyak import *
+
+INSTANCES = [RiverKeyak, LakeKeyak, SeaKeyak, OceanKeyak, LunarKeyak]
+DEFAULT_MAX_SIZE = (16 << 20)
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_THRESHOLD = 0.1
+
+K = "\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f"
+N = "\xf0\xe1\xd2\xc3\xb4\xa5\x96\x87\x78\x69\x5a\x4b\x3c\x2d\x1e\x0f"
+
+# Message sizes: 0 and powers of 16 from 16 bytes up to maxSize
+def messageSizes(maxSize):
+    sizes = [0]
+    size = 16
+    while (size <= maxSize):
+        sizes.append(size)
+        size *= 16
+    return sizes
+
+# Best time of calls to run(prepare()), repeated for at least minTime seconds in total (prepare is not timed)
+def measure(run, prepare, minTime):
+    best = None
+    total = 0.0
+    while ((best == None) or (total < minTime)):
+        arg = prepare()
+        start = time.time()
+        run(arg)
+        elapsed = (time.time() - start)
+        total += elapsed
+        if ((best == None) or (elapsed < best)):
+            best = elapsed
+    return best
+
+# Started wrapping and unwrapping sessions of an instance
+def startSessions(instance):
+    wrap = instance()
+    unwrap = instance()
+    wrap.StartEngine(K, N, False, bufferStream(), False, False)
+    unwrap.StartEngine(K, N, False, bufferStream(), True, False)
+    return (wrap, unwrap)
+
+def benchmarkInstance(instance, sizes, minTime, results):
+    name = instance.__name__
+
+    def startEngine(keyak):
+        keyak.StartEngine(K, N, False, bufferStream(), False, False)
+    t = measure(startEngine, instance, minTime)
+    results["%s/start_engine" % name] = {"value": t, "unit": "s", "better": "lower"}
+
+    (wrap, unwrap) = startSessions(instance)
+    for size in sizes:
+        message = os.urandom(size)
+        O = bufferStream(bytearray(size))
+        T = bufferStream()
+        wrap.fork().Wrap(bufferStream(message), O, bufferStream(), T, False, False)
+        (ciphertext, tag) = (O.getvalue(), T.getvalue())
+
+        def wrapMessage(keyak):
+            keyak.Wrap(bufferStream(message), bufferStream(bytearray(size)), bufferStream(), bufferStream(), False, False)
+        def unwrapMessage(keyak):
+            if not(keyak.Wrap(bufferStream(ciphertext), bufferStream(bytearray(size)), bufferStream(), bufferStream(tag), True, False)):
+                raise Exception("The benchmark tag does not verify.")
+
+        for (label, run, session) in [("wrap", wrapMessage, wrap), ("unwrap", unwrapMessage, unwrap)]:
+            t = measure(run, session.fork, minTime)
+            results["%s/%s/%d" % (name, label, size)] = {"value": t, "unit": "s", "better": "lower"}
+            if (size > 0):
+                results["%s/%s/%d/throughput" % (name, label, size)] = {"value": (size / t), "unit": "B/s", "better": "higher"}
+
+        def metadataOnly(keyak):
+            keyak.Wrap(bufferStream(), bufferStream(), bufferStream(message), bufferStream(), False, False)
+        t = measure(metadataOnly, wrap.fork, minTime)
+        results["%s/metadata_only/%d" % (name, size)] = {"value": t, "unit": "s", "better": "lower"}
+        sys.stderr.write("[*] %s: %d bytes\n" % (name, size))
+    return
+
+def benchmarkPermutations(instances, minTime, results):
+    done = set()
+    for instance in instances:
+        keyak = instance()
+        if ((keyak.b, keyak.nr) in done):
+            continue
+        done.add((keyak.b, keyak.nr))
+
+        f = KeccakP.get(keyak.b, keyak.nr)
+        state = bytearray(keyak.b / 8)
+        count = 100
+        def apply(unused):
+            for i in xrange(count):
+                f.apply(state)
+        t = measure(apply, lambda: None, minTime)
+        results["KeccakP[%d, %d]/apply" % (keyak.b, keyak.nr)] = {"value": (count / t), "unit": "1/s", "better": "higher"}
+    return
+
+def environment():
+    if (numpy != None):
+        numpyVersion = numpy.__version__
+    else:
+        numpyVersion = None
+    return {"python": sys.version.split()[0], "implementation": platform.python_implementation(), "platform": platform.platform(),
+            "numpy": numpyVersion, "backend": getBackend().name, "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+
+# Compare results to baseline results, returns the list of (name, baseline value, value, relative change) of regressions
+def compare(baseline, results, threshold):
+    regressions = []
+    for name in sorted(results):
+        if (name not in baseline):
+            continue
+        (old, new) = (baseline[name]["value"], results[name]["value"])
+        if (old <= 0):
+            continue
+        change = ((new - old) / float(old))
+        if (((results[name]["better"] == "lower") and (change > threshold)) or ((results[name]["better"] == "higher") and (change < -threshold))):
+            regressions.append((name, old, new, change))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the named Keyak instances.")
+    parser.add_argument("-i", "--instance", action="append", choices=[c.__name__ for c in INSTANCES], help="instance to benchmark (all by default, can be repeated)")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE, help="largest message size in bytes")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME, help="minimum time in seconds spent on each measurement")
+    parser.add_argument("-o", "--output", help="file to write the JSON results to (standard output by default)")
+    parser.add_argument("--baseline", help="JSON results file to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    instances = [c for c in INSTANCES if ((args.instance == None) or (c.__name__ in args.instance))]
+    results = {}
+    benchmarkPermutations(instances, args.min_time, results)
+    for instance in instances:
+        benchmarkInstance(instance, messageSizes(args.max_size), args.min_time, results)
+
+    report = {"environment": environment(), "results": results}
+    if (args.output != None):
+        with open(args.output, "wb") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if (args.baseline == None):
+        return 0
+    with open(args.baseline, "rb") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(baseline, results, args.threshold)
+    for (name, old, new, change) in regressions:
+        sys.stderr.write("[-] Regression: %s %g -> %g (%+.1f%%)\n" % (name, old, new, 100*change))
+    if (len(regressions) > 0):
+        return 1
+    sys.stderr.write("[+] No regressions against %s\n" % args.baseline)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Chunked file encryption container
+#
+# A container consists of a header followed by the wrapped chunks of the file:
+#   header: magic "KEYAKC" | version (1 byte) | instance (1 byte) | chunk size (4 bytes, big-endian) | file nonce (16 bytes)
+#   chunk i: ciphertext (chunk size bytes, less for the last chunk) | tag (16 bytes)
+# Every chunk is wrapped by a fresh session started under nonce (file nonce | i as 8-byte big-endian integer),
+# with metadata (header | final flag), where the final flag is 1 for the last chunk and 0 otherwise.
+# The header is thus authenticated by every chunk, reordered chunks fail under their nonce, and
+# truncating the container at a chunk boundary leaves a last chunk that was not wrapped as final.
+# An empty file is stored as a single, empty, final chunk.
+#
+# Input files are read through mmap and chunks are (un)wrapped by a multiprocessing pool.
+
+import os
+import sys
+import mmap
+import argparse
+from struct import pack, unpack
+from multiprocessing import Pool, cpu_count
+
+from keyak import *
+
+MAGIC = "KEYAKC"
+VERSION = 1
+HEADER_SIZE = (len(MAGIC) + 1 + 1 + 4 + 16)
+NONCE_SIZE = 16
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = (1 << 20)
+
+# Named instances by identifier stored in the header
+INSTANCES = [RiverKeyak, LakeKeyak, SeaKeyak, OceanKeyak, LunarKeyak]
+
+# Per-process state of the pool workers
+_worker = {}
+
+def _initWorker(path, K, header):
+    instance = ord(header[len(MAGIC) + 1])
+    _worker['K'] = K
+    _worker['header'] = header
+    _worker['keyak'] = INSTANCES[instance]
+    _worker['nonce'] = header[-NONCE_SIZE:]
+    _worker['file'] = open(path, 'rb')
+    size = os.fstat(_worker['file'].fileno()).st_size
+    if (size > 0):
+        _worker['data'] = mmap.mmap(_worker['file'].fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        _worker['data'] = ""
+    return
+
+# Start a session for chunk index and (un)wrap data, returns the output and tag streams and the result
+def _wrapChunk(index, data, T, final, unwrapFlag):
+    keyak = _worker['keyak']()
+    keyak.StartEngine(_worker['K'], _worker['nonce'] + pack('>Q', index), False, bufferStream(), False, False)
+    O = bufferStream()
+    res = keyak.Wrap(bufferStream(data), O, bufferStream(_worker['header'] + chr(final)), T, unwrapFlag, False)
+    return (O, T, res)
+
+def _encryptChunk(args):
+    (index, offset, length, final) = args
+    (O, T, res) = _wrapChunk(index, _worker['data'][offset:offset+length], bufferStream(), final, False)
+    return O.getvalue() + T.getvalue()
+
+def _decryptChunk(args):
+    (index, offset, length, final) = args
+    chunk = _worker['data'][offset:offset+length]
+    (O, T, res) = _wrapChunk(index, chunk[:-TAG_SIZE], bufferStream(chunk[-TAG_SIZE:]), final, True)
+    if not(res):
+        return None
+    return O.getvalue()
+
+# Run the chunk tasks in order, on a process pool unless processes is 1, yielding their results. Closing the
+# generator early (e.g. when a chunk fails) terminates the pool.
+def _mapChunks(function, tasks, path, K, header, processes):
+    if (processes == 1):
+        _initWorker(path, K, header)
+        try:
+            for task in tasks:
+                yield function(task)
+        finally:
+            _closeWorker()
+        return
+
+    pool = Pool(processes, _initWorker, (path, K, header))
+    try:
+        for result in pool.imap(function, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+# Release the input file mapped by _initWorker() in this process
+def _closeWorker():
+    if (isinstance(_worker.get('data'), mmap.mmap)):
+        _worker['data'].close()
+    if ('file' in _worker):
+        _worker['file'].close()
+    _worker.clear()
+    return
+
+# Encrypt the file at inPath into a container at outPath
+def encryptFile(inPath, outPath, K, instance = LakeKeyak, chunkSize = DEFAULT_CHUNK_SIZE, processes = None):
+    if ((chunkSize <= 0) or (chunkSize >= (1 << 32))):
+        raise Exception("The chunk size must be positive and fit on 32 bits.")
+
+    header = MAGIC + chr(VERSION) + chr(INSTANCES.index(instance)) + pack('>I', chunkSize) + os.urandom(NONCE_SIZE)
+    size = os.path.getsize(inPath)
+    count = max((size + chunkSize - 1) // chunkSize, 1)
+    tasks = [(i, i*chunkSize, min(chunkSize, size - i*chunkSize), int(i == (count - 1))) for i in xrange(count)]
+
+    chunks = _mapChunks(_encryptChunk, tasks, inPath, K, header, processes)
+    try:
+        with open(outPath, 'wb') as fout:
+            fout.write(header)
+            for chunk in chunks:
+                fout.write(chunk)
+    finally:
+        chunks.close()
+    return
+
+# Decrypt the container at inPath into outPath, returns whether all chunks are authentic.
+# Plaintext is written as chunks are verified; on failure the output file is removed.
+def decryptFile(inPath, outPath, K, processes = None):
+    with open(inPath, 'rb') as fin:
+        header = fin.read(HEADER_SIZE)
+    if ((len(header) != HEADER_SIZE) or not(header.startswith(MAGIC))):
+        raise Exception("The input is not a Keyak container.")
+    if (ord(header[len(MAGIC)]) != VERSION):
+        raise Exception("Unsupported container version %d." % ord(header[len(MAGIC)]))
+    if (ord(header[len(MAGIC) + 1]) >= len(INSTANCES)):
+        raise Exception("Unknown Keyak instance %d." % ord(header[len(MAGIC) + 1]))
+
+    chunkSize = unpack('>I', header[len(MAGIC)+2:len(MAGIC)+6])[0]
+    size = (os.path.getsize(inPath) - HEADER_SIZE)
+    count = max((size + chunkSize + TAG_SIZE - 1) // (chunkSize + TAG_SIZE), 1)
+    tasks = [(i, HEADER_SIZE + i*(chunkSize + TAG_SIZE), min(chunkSize + TAG_SIZE, size - i*(chunkSize + TAG_SIZE)), int(i == (count - 1))) for i in xrange(count)]
+    if (tasks[-1][2] < TAG_SIZE):
+        return False
+
+    res = True
+    chunks = _mapChunks(_decryptChunk, tasks, inPath, K, header, processes)
+    try:
+        with open(outPath, 'wb') as fout:
+            for chunk in chunks:
+                if (chunk == None):
+                    res = False
+                    break
+                fout.write(chunk)
+    finally:
+        chunks.close()
+    if not(res):
+        os.remove(outPath)
+    return res
+
+# Command line interface (python -m keyak encrypt|decrypt ...)
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m keyak", description="Encrypt or decrypt files in chunks with Keyak v2.")
+    parser.add_argument("mode", choices=["encrypt", "decrypt"])
+    parser.add_argument("input")
+    parser.add_argument("output")
+    keyGroup = parser.add_mutually_exclusive_group(required=True)
+    keyGroup.add_argument("-k", "--key", help="key as a hexadecimal string")
+    keyGroup.add_argument("--key-file", help="file containing the raw key")
+    parser.add_argument("-i", "--instance", default="LakeKeyak", choices=[c.__name__ for c in INSTANCES], help="named Keyak instance (encryption only)")
+    parser.add_argument("-c", "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="chunk size in bytes (encryption only)")
+    parser.add_argument("-j", "--processes", type=int, default=cpu_count(), help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    # Invalid keys, unreadable files and inputs that are not containers are reported on one line
+    try:
+        if (args.key != None):
+            K = args.key.decode('hex')
+        else:
+            with open(args.key_file, 'rb') as f:
+                K = f.read()
+
+        if (args.mode == "encrypt"):
+            instance = [c for c in INSTANCES if (c.__name__ == args.instance)][0]
+            encryptFile(args.input, args.output, K, instance, args.chunk_size, args.processes)
+            return 0
+
+        res = decryptFile(args.input, args.output, K, args.processes)
+    except Exception as e:
+        sys.stderr.write("[-] %s\n" % e)
+        return 1
+
+    if not(res):
+        sys.stderr.write("[-] Authentication failed, no output written.\n")
+        return 1
+    return 0
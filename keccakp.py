@@ -11,9 +11,28 @@
 # http://keccak.noekeon.org/
 # http://ketje.noekeon.org/
 
+import os
+import sys
+import json
+import time
+from struct import Struct
+
+# NumPy is optional and only used for batched permutations
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 # KeccakF class
 # KeccakF(b, n, s) specifies KeccakF[b] (as per Keccak documentation) with n rounds, starting at round index s
 class KeccakF(object):
+	# Number of states packed together by apply_batch
+	packedBatchSize = 16
+	# Minimum number of states for apply_batch to use NumPy on lists of lanes
+	arrayBatchThreshold = 32
+	# Round constants of the first rounds, computed by _InitRoundConstants
+	_roundConstants = ()
+
 	def __init__(self, b, aNrRounds, aStartRoundIndex = 0):
 		self.width = b
 		# Alignment unit in bits
@@ -25,6 +44,7 @@ class KeccakF(object):
 		self.nominalNrRounds = (aStartRoundIndex + aNrRounds)
 
 		self._InitRoundConstants()	
+		self._InitLaneTables()
 		return
 
 	# Public methods
@@ -37,26 +57,122 @@ class KeccakF(object):
 		# Make sure input state width is correct
 		assert(len(state) == (self.width / 8))
 
-		lanes = [[self._load(state[self.Wb*(x+5*y):self.Wb*(x+5*y)+self.Wb]) for y in range(5)] for x in range(5)]
-		lanes = self._KeccakFonLanes(lanes)
-		state = bytearray(self.width / 8)
-		for x in range(5):
-			for y in range(5):
-				state[self.Wb*(x+5*y):self.Wb*(x+5*y)+self.Wb] = self._store(lanes[x][y])
+		A = self.loadLanes(state)
+		self._Backend().permute(self, A)
+		return self.storeLanes(A)
+
+	# Apply permutation in place, either to a flat list of 25 lanes or to a (writable) byte state
+	def apply_inplace(self, state):
+		if (isinstance(state, list)):
+			assert(len(state) == 25)
+			self._Backend().permute(self, state)
+		else:
+			assert(len(state) == (self.width / 8))
+			A = self.loadLanes(state)
+			self._Backend().permute(self, A)
+			self.storeLanes(A, state)
+		return state
+
+	# Apply permutation to a batch of states, given either as an (N, 25) NumPy array of lanes (permuted in place)
+	# or as a list of flat lane lists (the permuted lanes are returned as a list of flat lane lists, see
+	# the permutation backends below for how they are processed).
+	def apply_batch(self, lanes):
+		if ((numpy != None) and isinstance(lanes, numpy.ndarray)):
+			assert((lanes.ndim == 2) and (lanes.shape[1] == 25))
+			A = numpy.ascontiguousarray(lanes, dtype=self.laneDtype)
+			self._KeccakFonLaneArray(A)
+			if (A is not lanes):
+				lanes[...] = A
+			return lanes
+
+		return self._Backend().permuteBatch(self, lanes)
+
+	# Get the permutation backend used by this permutation
+	def getBackend(self):
+		return self._Backend()
+
+	# Convert a byte state into a flat list of 25 lanes (lane (x, y) at index x+5*y)
+	def loadLanes(self, state):
+		if (self.laneStruct != None):
+			return list(self.laneStruct.unpack_from(state))
+		return [self._load(state[self.Wb*i:self.Wb*i+self.Wb]) for i in range(25)]
+
+	# Convert a flat list of 25 lanes into a byte state, writing into state if one is given
+	def storeLanes(self, A, state = None):
+		if (state == None):
+			state = bytearray(self.width / 8)
+		if (self.laneStruct != None):
+			self.laneStruct.pack_into(state, 0, *A)
+		else:
+			for i in range(25):
+				state[self.Wb*i:self.Wb*i+self.Wb] = self._store(A[i])
 		return state
 
 	# 'Protected' methods
-	# Pre-compute round constant table
+	# The active backend, or the optimized one if the active backend does not support the lane size
+	def _Backend(self):
+		backend = _activeBackend
+		if (backend == None):
+			backend = selectBackend()
+		if not(backend.supports(self)):
+			backend = _backends['optimized']
+		return backend
+
+	# Pre-compute round constant table (the LFSR output is computed once per process and shared by all instances)
 	def _InitRoundConstants(self):
-		self.RC = [0]*self.nominalNrRounds
-		R = 1
-		for roundIndex in range(self.nominalNrRounds):
-			rc = 0
-			for j in range(7):
-				R = ((R << 1) ^ ((R >> 7)*0x71)) % 256
-				if (R & 2):
-					rc ^= (1 << ((1<<j)-1))
-			self.RC[roundIndex] = rc
+		if (len(KeccakF._roundConstants) < self.nominalNrRounds):
+			RC = [0]*self.nominalNrRounds
+			R = 1
+			for roundIndex in range(self.nominalNrRounds):
+				rc = 0
+				for j in range(7):
+					R = ((R << 1) ^ ((R >> 7)*0x71)) % 256
+					if (R & 2):
+						rc ^= (1 << ((1<<j)-1))
+				RC[roundIndex] = rc
+			KeccakF._roundConstants = tuple(RC)
+		self.RC = list(KeccakF._roundConstants[:self.nominalNrRounds])
+		return
+
+	# Pre-compute ρ and π tables for flat lane states (lane (x, y) is stored at index x+5*y)
+	def _InitLaneTables(self):
+		self.laneMask = ((1 << self.W) - 1)
+		# Round constants truncated to the lane size
+		self.laneRC = [(rc & self.laneMask) for rc in self.RC]
+
+		rho = [0]*25
+		(x, y) = (1, 0)
+		for t in range(24):
+			rho[x+5*y] = (((t+1)*(t+2)//2) % self.W) if (self.W > 0) else 0
+			(x, y) = (y, (2*x+3*y)%5)
+
+		# Combined ρ and π: (source lane, destination lane, rotation offset)
+		self.rhoPi = tuple((x+5*y, y+5*((2*x+3*y)%5), rho[x+5*y]) for y in range(5) for x in range(5))
+
+		# Lanes are packed little-endian, use struct whenever the lane size is a native type
+		laneFormats = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+		if (self.Wb in laneFormats):
+			self.laneFormat = laneFormats[self.Wb]
+			self.laneStruct = Struct('<25' + self.laneFormat)
+		else:
+			self.laneFormat = None
+			self.laneStruct = None
+
+		# Tables for batched permutations on NumPy lane arrays, indexed by destination lane
+		laneDtypes = {8: 'uint8', 16: 'uint16', 32: 'uint32', 64: 'uint64'}
+		if ((numpy != None) and (self.W in laneDtypes)):
+			self.laneDtype = numpy.dtype(laneDtypes[self.W])
+			piSource = [0]*25
+			piRotation = [0]*25
+			for (src, dst, r) in self.rhoPi:
+				piSource[dst] = src
+				piRotation[dst] = r
+			self.piSource = numpy.array(piSource, dtype='intp')
+			self.piRotationLeft = numpy.array(piRotation, dtype=self.laneDtype)
+			self.piRotationRight = numpy.array([((self.W - r) % self.W) for r in piRotation], dtype=self.laneDtype)
+			self.laneArrayRC = numpy.array(self.laneRC, dtype=self.laneDtype)
+		else:
+			self.laneDtype = None
 		return
 
 	# Apply permutation to lanes
@@ -81,10 +197,113 @@ class KeccakF(object):
 				for x in range(5):
 					lanes[x][y] = T[x] ^((~T[(x+1)%5]) & T[(x+2)%5])
 
-			# ι		
-			lanes[0][0] ^= self.RC[roundIndex]
+			# ι (with the round constant truncated to the lane size, bits above it would leak back in through _ROL)
+			lanes[0][0] ^= self.laneRC[roundIndex]
 		return lanes
 
+	# Apply permutation in place to a flat list of 25 lanes
+	# With a replicated mask and round constants, each lane may also hold several
+	# lanes packed in slots of 2*W bits (see _KeccakFonPackedLanes)
+	def _KeccakFonFlatLanes(self, A, mask = None, RC = None):
+		W = self.W
+		if (mask == None):
+			mask = self.laneMask
+			RC = self.laneRC
+		rhoPi = self.rhoPi
+		B = [0]*25
+		for roundIndex in range(self.aStartRoundIndex, (self.aStartRoundIndex + self.aNrRounds)):
+			# θ
+			C0 = A[0] ^ A[5] ^ A[10] ^ A[15] ^ A[20]
+			C1 = A[1] ^ A[6] ^ A[11] ^ A[16] ^ A[21]
+			C2 = A[2] ^ A[7] ^ A[12] ^ A[17] ^ A[22]
+			C3 = A[3] ^ A[8] ^ A[13] ^ A[18] ^ A[23]
+			C4 = A[4] ^ A[9] ^ A[14] ^ A[19] ^ A[24]
+			D0 = C4 ^ (((C1 << 1) | (C1 >> (W-1))) & mask)
+			D1 = C0 ^ (((C2 << 1) | (C2 >> (W-1))) & mask)
+			D2 = C1 ^ (((C3 << 1) | (C3 >> (W-1))) & mask)
+			D3 = C2 ^ (((C4 << 1) | (C4 >> (W-1))) & mask)
+			D4 = C3 ^ (((C0 << 1) | (C0 >> (W-1))) & mask)
+			for y in (0, 5, 10, 15, 20):
+				A[y] ^= D0
+				A[y+1] ^= D1
+				A[y+2] ^= D2
+				A[y+3] ^= D3
+				A[y+4] ^= D4
+
+			# ρ and π
+			for (src, dst, r) in rhoPi:
+				a = A[src]
+				B[dst] = ((a << r) | (a >> (W-r))) & mask
+
+			# χ
+			for y in (0, 5, 10, 15, 20):
+				(B0, B1, B2, B3, B4) = B[y:y+5]
+				A[y] = B0 ^ ((~B1) & B2)
+				A[y+1] = B1 ^ ((~B2) & B3)
+				A[y+2] = B2 ^ ((~B3) & B4)
+				A[y+3] = B3 ^ ((~B4) & B0)
+				A[y+4] = B4 ^ ((~B0) & B1)
+
+			# ι
+			A[0] ^= RC[roundIndex]
+		return A
+
+	# Apply permutation to k states at once (SWAR), with A a list of 25 packed lanes where
+	# lane i of state j sits in bits [2*W*j, 2*W*j + W) of A[i]. The upper W bits of every slot
+	# are guard bits absorbing the bits that shifts and rotations push out of a lane, and are
+	# cleared again by masking so that slots never interact.
+	def _KeccakFonPackedLanes(self, A, k):
+		ones = self._packedOnes(k)
+		self._KeccakFonFlatLanes(A, (self.laneMask * ones), [(rc * ones) for rc in self.laneRC])
+		return A
+
+	# Pack the lanes of k states (a list of k flat lane lists) into 25 packed lanes
+	def packLanes(self, states):
+		slot = (2 * self.W)
+		P = [0]*25
+		for A in reversed(states):
+			for i in range(25):
+				P[i] = ((P[i] << slot) | A[i])
+		return P
+
+	# Unpack 25 packed lanes into a list of k flat lane lists
+	def unpackLanes(self, P, k):
+		slot = (2 * self.W)
+		return [[((P[i] >> (slot*j)) & self.laneMask) for i in range(25)] for j in range(k)]
+
+	# Integer with bit 0 of each of the k slots set, replicates a lane-sized value into every slot
+	def _packedOnes(self, k):
+		ones = 0
+		for j in range(k):
+			ones = ((ones << (2 * self.W)) | 1)
+		return ones
+
+	# Apply permutation in place to an (N, 25) C-contiguous NumPy array of lanes
+	def _KeccakFonLaneArray(self, A):
+		N = A.shape[0]
+		one = self.laneDtype.type(1)
+		Wminus1 = self.laneDtype.type(self.W - 1)
+		# Lane (x, y) of state n is A3[n, y, x]
+		A3 = A.reshape(N, 5, 5)
+		for roundIndex in range(self.aStartRoundIndex, (self.aStartRoundIndex + self.aNrRounds)):
+			# θ
+			C = A3[:, 0] ^ A3[:, 1] ^ A3[:, 2] ^ A3[:, 3] ^ A3[:, 4]
+			C1 = numpy.roll(C, -1, axis=1)
+			D = numpy.roll(C, 1, axis=1) ^ ((C1 << one) | (C1 >> Wminus1))
+			A3 ^= D[:, numpy.newaxis, :]
+
+			# ρ and π
+			B = A[:, self.piSource]
+			B = (B << self.piRotationLeft) | (B >> self.piRotationRight)
+
+			# χ
+			B3 = B.reshape(N, 5, 5)
+			A3[...] = B3 ^ ((~numpy.roll(B3, -1, axis=2)) & numpy.roll(B3, -2, axis=2))
+
+			# ι
+			A[:, 0] ^= self.laneArrayRC[roundIndex]
+		return A
+
 	# Helper functions
 	def _ROL(self, a, n):
 		return ((a >> (self.W-(n%self.W))) + (a << (n%self.W))) % (1 << self.W)
@@ -104,4 +323,221 @@ class KeccakP(KeccakF):
 
 		# Determine nominal number of rounds and starting round index
 		nominalNrRounds = {25: 12, 50: 14, 100: 16, 200: 18, 400: 20, 800: 22, 1600: 24}
-		return super(KeccakP, self).__init__(b, nr, (nominalNrRounds[b] - nr))
\ No newline at end of file
+		return super(KeccakP, self).__init__(b, nr, (nominalNrRounds[b] - nr))
+
+	# Get the process-wide shared KeccakP[b, nr] instance. Permutation objects are never modified after
+	# construction, so a single instance (and its constants tables) can serve any number of sessions.
+	@staticmethod
+	def get(b, nr):
+		f = _sharedPermutations.get((b, nr))
+		if (f == None):
+			f = _sharedPermutations.setdefault((b, nr), KeccakP(b, nr))
+		return f
+
+# Shared KeccakP instances by (b, nr), see KeccakP.get()
+_sharedPermutations = {}
+# Permutation backends
+#
+# A backend permutes a single state (permute(f, A), with A a flat list of 25 lanes permuted in place)
+# and a batch of states (permuteBatch(f, states), with states a list of flat lane lists, returning the
+# list of permuted lanes) for a KeccakF instance f. Permutations of lane sizes a backend does not
+# support use the optimized backend instead.
+#   reference: the reference implementation on a 5x5 matrix of lanes (_KeccakFonLanes)
+#   optimized: unrolled pure Python on flat lanes (_KeccakFonFlatLanes)
+#   numpy: NumPy lane arrays (_KeccakFonLaneArray), when NumPy is available
+#   batched: optimized for single states, batches are packed SWAR-style and large ones use NumPy when available
+#
+# The active backend is chosen once per process: by setBackend(), else by the KEYAK_BACKEND environment
+# variable, else by a short micro-benchmark of all available backends. Its outcome is cached on disk
+# per interpreter and NumPy version, in the file named by KEYAK_BACKEND_CACHE (empty to disable the
+# cache) or in keyak/backends.json under $XDG_CACHE_HOME (~/.cache by default).
+class PermutationBackend(object):
+	name = None
+	# Whether multi-piston engines should keep their states in NumPy lane arrays
+	vectorized = False
+
+	# Public methods
+	def available(self):
+		return True
+
+	def supports(self, f):
+		return True
+
+	def permute(self, f, A):
+		raise NotImplementedError
+
+	def permuteBatch(self, f, states):
+		for A in states:
+			self.permute(f, A)
+		return states
+
+class ReferenceBackend(PermutationBackend):
+	name = 'reference'
+
+	def permute(self, f, A):
+		lanes = f._KeccakFonLanes([[A[x+5*y] for y in range(5)] for x in range(5)])
+		for y in range(5):
+			for x in range(5):
+				A[x+5*y] = lanes[x][y]
+		return A
+
+class OptimizedBackend(PermutationBackend):
+	name = 'optimized'
+
+	def permute(self, f, A):
+		return f._KeccakFonFlatLanes(A)
+
+class NumpyBackend(PermutationBackend):
+	name = 'numpy'
+	vectorized = True
+
+	def available(self):
+		return (numpy != None)
+
+	def supports(self, f):
+		return (f.laneDtype != None)
+
+	def permute(self, f, A):
+		B = numpy.array([A], dtype=f.laneDtype)
+		f._KeccakFonLaneArray(B)
+		A[:] = B[0].tolist()
+		return A
+
+	def permuteBatch(self, f, states):
+		if (len(states) == 0):
+			return []
+		A = numpy.array(states, dtype=f.laneDtype).reshape(len(states), 25)
+		f._KeccakFonLaneArray(A)
+		return A.tolist()
+
+class BatchedBackend(OptimizedBackend):
+	name = 'batched'
+
+	def permuteBatch(self, f, states):
+		if ((f.laneDtype != None) and (len(states) >= f.arrayBatchThreshold)):
+			return _backends['numpy'].permuteBatch(f, states)
+
+		result = []
+		for offset in range(0, len(states), f.packedBatchSize):
+			group = states[offset:offset+f.packedBatchSize]
+			result.extend(f.unpackLanes(f._KeccakFonPackedLanes(f.packLanes(group), len(group)), len(group)))
+		return result
+
+# Registered backends by name, see registerBackend()
+_backends = {}
+# Active backend, None until one is selected
+_activeBackend = None
+
+# Register a backend (an instance of a PermutationBackend subclass with a unique name)
+def registerBackend(backend):
+	_backends[backend.name] = backend
+	return
+
+# Names of the registered backends that are available in this process
+def backendNames():
+	return sorted(name for name in _backends if _backends[name].available())
+
+# Make the backend with the given name active, or select one again as on first use if name is None.
+# Applies to all permutation objects; engines of sessions created before keep their layout.
+def setBackend(name):
+	global _activeBackend
+	if (name == None):
+		_activeBackend = None
+		return selectBackend()
+	if (name not in backendNames()):
+		raise Exception("Unknown or unavailable permutation backend %r." % (name,))
+	_activeBackend = _backends[name]
+	return _activeBackend
+
+# Get the active backend, selecting one if none is active yet
+def getBackend():
+	if (_activeBackend == None):
+		return selectBackend()
+	return _activeBackend
+
+# Select the active backend from KEYAK_BACKEND, the benchmark cache or a new benchmark
+def selectBackend():
+	global _activeBackend
+	name = os.environ.get('KEYAK_BACKEND')
+	if (name):
+		return setBackend(name)
+
+	key = _InterpreterKey()
+	cache = _LoadBackendCache()
+	name = cache.get(key, {}).get('backend')
+	if (name not in backendNames()):
+		timings = benchmarkBackends()
+		name = min(timings, key=timings.get)
+		cache[key] = {'backend': name, 'timings': timings}
+		_StoreBackendCache(cache)
+	_activeBackend = _backends[name]
+	return _activeBackend
+
+# Time every available backend on KeccakP[1600, 12]: 4 single permutations and a batch of 4 states
+# (as used by 1 and 4 piston instances), best of repeat runs. Returns the timings in seconds by name.
+def benchmarkBackends(repeat = 3):
+	f = KeccakP(1600, 12)
+	timings = {}
+	for name in backendNames():
+		backend = _backends[name]
+		best = None
+		for r in range(repeat):
+			states = [[((i * 0x9e3779b97f4a7c15 + j) & f.laneMask) for i in range(25)] for j in range(4)]
+			start = time.time()
+			for A in states:
+				backend.permute(f, A)
+			backend.permuteBatch(f, states)
+			elapsed = (time.time() - start)
+			if ((best == None) or (elapsed < best)):
+				best = elapsed
+		timings[name] = best
+	return timings
+
+def _InterpreterKey():
+	if (numpy != None):
+		numpyVersion = numpy.__version__
+	else:
+		numpyVersion = 'none'
+	return '%s|%s|numpy-%s' % (sys.executable, sys.version.split()[0], numpyVersion)
+
+def _BackendCachePath():
+	path = os.environ.get('KEYAK_BACKEND_CACHE')
+	if (path != None):
+		return path
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'keyak', 'backends.json')
+
+def _LoadBackendCache():
+	path = _BackendCachePath()
+	if (path == ''):
+		return {}
+	try:
+		with open(path, 'rb') as f:
+			cache = json.load(f)
+		if (isinstance(cache, dict)):
+			return cache
+	except (IOError, OSError, ValueError):
+		pass
+	return {}
+
+# The cache is only an optimization, so failing to write it is not an error
+def _StoreBackendCache(cache):
+	path = _BackendCachePath()
+	if (path == ''):
+		return
+	try:
+		directory = os.path.dirname(path)
+		if ((directory != '') and not(os.path.isdir(directory))):
+			os.makedirs(directory)
+		temporary = ('%s.%d' % (path, os.getpid()))
+		with open(temporary, 'wb') as f:
+			json.dump(cache, f, indent=1, sort_keys=True)
+		os.rename(temporary, path)
+	except (IOError, OSError):
+		pass
+	return
+
+registerBackend(ReferenceBackend())
+registerBackend(OptimizedBackend())
+registerBackend(NumpyBackend())
+registerBackend(BatchedBackend())
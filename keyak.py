@@ -24,32 +24,116 @@ class Keyak(object):
         self.tau = tau
         self.W = max((b/25), 8)
         self.c = ac
-        self.motorist = Motorist(KeccakP(b, nr), Pi, self.W, self.c, tau)
+        self.motorist = Motorist(KeccakP.get(b, nr), Pi, self.W, self.c, tau)
         return
 
+    # Get a new session in the ready phase, for the named instances (e.g. LakeKeyak.new()) or with the
+    # parameters (b, nr, Pi, c, tau) of the constructor (e.g. Keyak.new(1600, 12, 1, 256, 128)).
+    # Sessions are forked from a process-wide prototype built once per class, parameters and active
+    # permutation backend (which determines the engine), so no permutation tables, piston rates or
+    # states are computed per session.
+    @classmethod
+    def new(cls, *args):
+        key = ((cls, getBackend().name) + args)
+        prototype = _prototypes.get(key)
+        if (prototype == None):
+            prototype = _prototypes.setdefault(key, cls(*args))
+        return prototype.fork()
+
     # Public methods
     def StartEngine(self, K, N, tagFlag, T, unwrapFlag, forgetFlag):
-        lk = (self.W/8*((self.c+9+self.W-1)/self.W))
-        SUV = stringStream(self._keypack(K, lk) + N)
+        SUV = bufferStream(self._keypack(K, self._keypackLength()) + N)
         return self.motorist.StartEngine(SUV, tagFlag, T, unwrapFlag, forgetFlag)
 
+    # StartEngine with the key setup precomputed in a KeyContext (see keycache.py), which only absorbs the nonce
+    def StartEngineWithContext(self, context, N, tagFlag, T, unwrapFlag, forgetFlag):
+        if (context.parameters != (self.b, self.nr, self.Pi, self.c, self.tau)):
+            raise Exception("The key context was made for other instance parameters.")
+        if (context.prepared == None):
+            raise Exception("The key context has been zeroized.")
+        return self.motorist.StartEngineFrom(context.prepared, context.skip, bufferStream(N), tagFlag, T, unwrapFlag, forgetFlag)
+
     def Wrap(self, I, O, A, T, unwrapFlag, forgetFlag):
         return self.motorist.Wrap(I, O, A, T, unwrapFlag, forgetFlag)
 
-    # Fetch info string on keyak object
-    def GetInfo(self):
+    # Wrap into and unwrap from caller-provided buffers, see Motorist.wrap_into() and Motorist.unwrap_into()
+    def wrap_into(self, out, outOffset, I, A, tag, tagOffset, forgetFlag):
+        return self.motorist.wrap_into(out, outOffset, I, A, tag, tagOffset, forgetFlag)
+
+    def unwrap_into(self, out, outOffset, C, A, tag, tagOffset, forgetFlag):
+        return self.motorist.unwrap_into(out, outOffset, C, A, tag, tagOffset, forgetFlag)
+
+    # Get an independent copy of the session
+    def fork(self):
+        other = shallowCopy(self)
+        other.motorist = self.motorist.fork()
+        return other
+
+    # Take a snapshot of the session (an independent copy) that can be restored later
+    def snapshot(self):
+        return self.fork()
+
+    # Restore the session state of a snapshot (which remains usable)
+    def restore(self, snapshot):
+        self.motorist.restore(snapshot.motorist)
+        return
+
+    # Start collecting statistics on the session, see Motorist.enableStats()
+    def enableStats(self, callback = None):
+        return self.motorist.enableStats(callback)
+
+    def disableStats(self):
+        self.motorist.disableStats()
+        return
+
+    # Get the statistics collected on the session, see Instrumentation
+    def stats(self):
+        return self.motorist.stats()
+
+    # Serialize the session, see Motorist.to_bytes()
+    def to_bytes(self):
+        return self.motorist.to_bytes()
+
+    # Serialize the session into a writable buffer at offset, see Motorist.pack_into()
+    def pack_into(self, buf, offset = 0):
+        return self.motorist.pack_into(buf, offset)
+
+    # Deserialize a session serialized by to_bytes() or pack_into()
+    @staticmethod
+    def from_bytes(buf, offset = 0):
+        motorist = Motorist.from_bytes(buf, offset)
+        f = motorist.Pistons[0].f
+        keyak = Keyak.new(f.getWidth(), f.aNrRounds, motorist.Pi, motorist.c, motorist.tau)
+        keyak.motorist = motorist
+        return keyak
+
+    # Wrap for several independent Keyak sessions in lockstep, with I, O, A and T lists of streams (one per session).
+    # Produces the same output as separate Wrap calls but permutes all sessions at once per block.
+    @staticmethod
+    def wrap_many(sessions, I, O, A, T, unwrapFlag, forgetFlag):
+        return Motorist.wrap_many([k.motorist for k in sessions], I, O, A, T, unwrapFlag, forgetFlag)
+
+    # Fetch name string on keyak object (as used in the test vectors)
+    def GetName(self):
         return "Keyak[b=%d, nr=%d, Pi=%d, c=%d, tau=%d]" % (self.b, self.nr, self.Pi, self.c, self.tau)
 
+    # Fetch info string on keyak object, including the active permutation backend
+    def GetInfo(self):
+        return "%s (backend: %s)" % (self.GetName(), self.motorist.Pistons[0].f.getBackend().name)
+
     # 'Protected' methods
+    def _keypackLength(self):
+        return (self.W/8*((self.c+9+self.W-1)/self.W))
+
     def _keypack(self, K, l):
         if ((len(K) + 2) > l):
             raise Exception("The key is too big and does not fit in the key pack.")
 
         result = chr(enc8(l)) + K + chr(0x01)
+        return result.ljust(l, chr(0x00))
 
-        while (len(result) < l):
-            result += chr(0x00)
-        return result
+# Prototype sessions by class, active backend and constructor parameters, see Keyak.new()
+_prototypes = {}
 
 # Keyak named instances
 class RiverKeyak(Keyak):
@@ -70,4 +154,10 @@ class OceanKeyak(Keyak):
 
 class LunarKeyak(Keyak):
     def __init__(self):
-        return super(LunarKeyak, self).__init__(1600, 12, 8, 256, 128)
\ No newline at end of file
+        return super(LunarKeyak, self).__init__(1600, 12, 8, 256, 128)
+
+# Command line interface for chunked file encryption, see container.py
+if __name__ == '__main__':
+    import sys
+    from container import main
+    sys.exit(main(sys.argv[1:]))
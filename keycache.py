@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Per-key setup cache for servers starting many sessions under a small set of long-term keys
+#
+# StartEngine absorbs the SUV, the key pack followed by the nonce. A KeyContext holds the key pack of a key
+# and the piston state after absorbing it (the full blocks of it are absorbed and permuted, the rest is
+# XORed into the state), so that starting a session from it only absorbs the nonce. A KeyCache keeps the
+# contexts of the most recently used keys, up to its capacity, and counts hits, misses and evictions.
+#
+# Contexts removed with evict() or clear() are zeroized in place. Contexts dropped because the cache is
+# full are not, as they may still be in use by a session being started on another thread; they are
+# released to the garbage collector like the keys themselves.
+#
+# The permutation that follows the nonce dominates StartEngine: on CPython 2.7.18, a LakeKeyak StartEngine
+# with a 58-byte nonce takes about 290 us either way, of which the key pack and its absorption are under 10 us.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from keyak import *
+
+DEFAULT_CAPACITY = 64
+
+# KeyContext class
+# Key setup of a key K for the sessions of the instance of a Keyak object (any session with its parameters)
+class KeyContext(object):
+    def __init__(self, keyak, K):
+        self.parameters = (keyak.b, keyak.nr, keyak.Pi, keyak.c, keyak.tau)
+        lk = keyak._keypackLength()
+        self.keypack = bytearray(keyak._keypack(K, lk))
+
+        # The key pack is the same for all pistons, and so is their state after absorbing it
+        motorist = Motorist(KeccakP.get(keyak.b, keyak.nr), keyak.Pi, keyak.W, keyak.c, keyak.tau)
+        engine = motorist.engine
+        Ra = motorist.Pistons[0].Ra
+        x = engine._SegmentView(self.keypack)
+        full = ((lk / Ra) * Ra)
+        for offset in xrange(0, full, Ra):
+            for i in xrange(keyak.Pi):
+                engine._InjectSegment(i, x[offset:offset+Ra], False)
+            engine._Spark(False, [0x00]*keyak.Pi)
+        self.prepared = bytearray(engine.getState(0))
+        self.prepared[0:lk-full] = xorBytes(self.prepared[0:lk-full], self.keypack[full:])
+        # Number of bytes of the current block absorbed already
+        self.skip = (lk - full)
+        return
+
+    # Public methods
+    # Overwrite the key pack and prepared state with zeros, after which the context cannot be used
+    def zeroize(self):
+        if (self.prepared != None):
+            self.keypack[:] = bytearray(len(self.keypack))
+            self.prepared[:] = bytearray(len(self.prepared))
+            self.prepared = None
+        return
+
+# KeyCache class
+# Bounded LRU cache of KeyContext objects by instance parameters and key. Thread-safe.
+class KeyCache(object):
+    def __init__(self, capacity = DEFAULT_CAPACITY):
+        if (capacity < 1):
+            raise Exception("The capacity must be at least 1.")
+        self.capacity = capacity
+        self.contexts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        return
+
+    # Public methods
+    # Get the context of key K for the instance of keyak, making it on a miss
+    def get(self, keyak, K):
+        index = self._Index(keyak, K)
+        with self.lock:
+            context = self.contexts.pop(index, None)
+            if (context != None):
+                self.hits += 1
+                self.contexts[index] = context
+                return context
+            self.misses += 1
+
+        # Made outside of the lock, concurrent misses on the same key may both make it
+        context = KeyContext(keyak, K)
+        with self.lock:
+            self.contexts[index] = context
+            while (len(self.contexts) > self.capacity):
+                self.contexts.popitem(last=False)
+                self.evictions += 1
+        return context
+
+    # StartEngine on keyak with the cached context of key K, see Keyak.StartEngineWithContext()
+    def StartEngine(self, keyak, K, N, tagFlag, T, unwrapFlag, forgetFlag):
+        return keyak.StartEngineWithContext(self.get(keyak, K), N, tagFlag, T, unwrapFlag, forgetFlag)
+
+    # Remove and zeroize the contexts of key K (for all instances), returns the number of contexts removed
+    def evict(self, K):
+        digest = hashlib.sha256(K).digest()
+        with self.lock:
+            removed = [index for index in self.contexts if (index[1] == digest)]
+            for index in removed:
+                self.contexts.pop(index).zeroize()
+            self.evictions += len(removed)
+        return len(removed)
+
+    # Remove and zeroize all contexts
+    def clear(self):
+        with self.lock:
+            for context in self.contexts.values():
+                context.zeroize()
+            self.evictions += len(self.contexts)
+            self.contexts.clear()
+        return
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.contexts), 'capacity': self.capacity}
+
+    def __len__(self):
+        return len(self.contexts)
+
+    # 'Protected' methods
+    # Contexts are indexed by a digest of the key rather than by the key itself
+    def _Index(self, keyak, K):
+        return ((keyak.b, keyak.nr, keyak.Pi, keyak.c, keyak.tau), hashlib.sha256(K).digest())
@@ -11,7 +11,17 @@
 # http://keccak.noekeon.org/
 # http://ketje.noekeon.org/
 
+import time
+from struct import Struct, pack, unpack
+
 from utils import *
+from keccakp import *
+
+# NumPy is optional and only used by VectorEngine
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Pre-PEP 435 compatible 'enum' types
 class EnginePhase:
@@ -21,14 +31,135 @@ class MotoristPhase:
     ready, riding, failed = range(3)
 
 # State class
+# The state is kept as a flat list of lanes across permutation calls. Pistons XOR and read
+# bytes in the lanes they touch, the state is only materialized as bytes (in place, in the
+# same buffer) when all of it is accessed (e.g. when it is serialized).
+# Copies share their buffers until either of them modifies the state (copy-on-write).
 class State(object):
-    def __init__(self, stateSize):
+    def __init__(self, stateSize, aF = None):
         self.stateSize = stateSize
-        self.s = bytearray([0 for i in range(self.stateSize)])
+        self.f = aF
+        self.s = bytearray(self.stateSize)
+        self.lanes = None
+        self.inLanes = False
+        self.shared = False
         return
 
     def reset(self):
-        self.s = bytearray([0 for i in range(self.stateSize)])
+        self.s = bytearray(self.stateSize)
+        self.lanes = None
+        self.inLanes = False
+        self.shared = False
+        return
+
+    # Get a copy of the state
+    def copy(self):
+        other = shallowCopy(self)
+        self.shared = True
+        other.shared = True
+        return other
+
+    # Get byte representation of the state
+    def getBytes(self):
+        self._Own()
+        if (self.inLanes):
+            self.f.storeLanes(self.lanes, self.s)
+            self.inLanes = False
+        return self.s
+
+    # Replace the state by the given bytes
+    def setBytes(self, s):
+        self.s = bytearray(s)
+        self.lanes = None
+        self.inLanes = False
+        self.shared = False
+        return
+
+    # Get lane representation of the state
+    def getLanes(self):
+        self._Own()
+        if not(self.inLanes):
+            self.lanes = self.f.loadLanes(self.s)
+            self.inLanes = True
+        return self.lanes
+
+    # XOR a single byte into the state without changing representation
+    def xorByte(self, offset, x):
+        self._Own()
+        if (self.inLanes):
+            self.lanes[offset // self.f.Wb] ^= (x << (8*(offset % self.f.Wb)))
+        else:
+            self.s[offset] ^= x
+        return
+
+    # XOR the bytes x into the state at offset, into the lanes they touch without changing representation
+    def xorBytes(self, offset, x):
+        n = len(x)
+        if (n == 0):
+            return
+        self._Own()
+        if (self.inLanes and (self.f.laneFormat != None)):
+            Wb = self.f.Wb
+            first = (offset // Wb)
+            lead = (offset - first*Wb)
+            count = ((lead + n + Wb - 1) // Wb)
+            block = bytearray(count*Wb)
+            block[lead:lead+n] = x
+            values = unpack('<%d%s' % (count, self.f.laneFormat), bytes(block))
+            lanes = self.lanes
+            for i in xrange(count):
+                lanes[first+i] ^= values[i]
+        else:
+            s = self.getBytes()
+            s[offset:offset+n] = xorBytes(s[offset:offset+n], x)
+        return
+
+    # Get a copy of the bytes of the state from start to end, from the lanes they are in without changing representation
+    def readBytes(self, start, end):
+        if (self.inLanes and (self.f.laneFormat != None)):
+            Wb = self.f.Wb
+            first = (start // Wb)
+            last = ((end + Wb - 1) // Wb)
+            block = pack('<%d%s' % (last - first, self.f.laneFormat), *self.lanes[first:last])
+            return bytearray(block[start-first*Wb:end-first*Wb])
+        return self.getBytes()[start:end]
+
+    # Apply the permutation in place
+    def permute(self):
+        self.f.apply_inplace(self.getLanes())
+        return
+
+    # Replace the state by the given lanes
+    def setLanes(self, lanes):
+        self.lanes = lanes
+        self.inLanes = True
+        return
+
+    # Apply the permutation in place to several states, batching states that share a permutation
+    @staticmethod
+    def permuteAll(states):
+        groups = {}
+        for state in states:
+            key = (state.f.getWidth(), state.f.aStartRoundIndex, state.f.aNrRounds)
+            groups.setdefault(key, []).append(state)
+
+        for group in groups.values():
+            if (len(group) == 1):
+                group[0].permute()
+            else:
+                lanes = group[0].f.apply_batch([state.getLanes() for state in group])
+                for i in xrange(len(group)):
+                    group[i].setLanes(lanes[i])
+        return
+
+    # 'Protected' methods
+    # Stop sharing buffers with copies before modifying them
+    def _Own(self):
+        if (self.shared):
+            self.s = bytearray(self.s)
+            if (self.lanes != None):
+                self.lanes = list(self.lanes)
+            self.shared = False
         return
 
 # Piston class
@@ -48,9 +179,8 @@ class Piston(object):
 
             b = self.f.getWidth()
 
-            self.state = State((b+7)/8)
-            # State is initalized to other state
-            self.state.s = other.state.s
+            # State is initalized to (a copy of) other state
+            self.state = other.state.copy()
         else:
             self.f = kwargs['aF']
             self.Rs = kwargs['aRs']
@@ -63,7 +193,7 @@ class Piston(object):
                 raise Exception("Ra is larger than (b-32)/8.")
 
             # State is initialized to all zero
-            self.state = State((b+7)/8)
+            self.state = State((b+7)/8, self.f)
 
             self.EOM = self.Ra
             self.CryptEnd = (self.Ra + 1)
@@ -73,15 +203,17 @@ class Piston(object):
 
     # Public methods
     def Crypt(self, I, O, omega, unwrapFlag):
-        while(hasMore(I) and (omega < self.Rs)):
-            x = I.get()
-            O.put(self.state.s[omega] ^ x)
-            if(unwrapFlag):
-                self.state.s[omega] = x
-            else:
-                self.state.s[omega] ^= x
-            omega += 1
-        self.state.s[self.CryptEnd] ^= enc8(omega)
+        X = I.getBytes(self.Rs - omega)
+        end = (omega + len(X))
+        # When unwrapping the state is overwritten with the ciphertext, which is the input
+        if(unwrapFlag):
+            Y = xorBytes(self.state.readBytes(omega, end), X)
+            self.state.xorBytes(omega, Y)
+        else:
+            self.state.xorBytes(omega, X)
+            Y = self.state.readBytes(omega, end)
+        O.putBytes(Y)
+        self.state.xorByte(self.CryptEnd, enc8(end))
         return
 
     def Inject(self, X, cryptingFlag):
@@ -89,35 +221,61 @@ class Piston(object):
             omega = self.Rs
         else:
             omega = 0
-        self.state.s[self.InjectStart] ^= enc8(omega)
-
-        while(hasMore(X) and (omega < self.Ra)):
-            self.state.s[omega] ^= X.get()
-            omega += 1
-
-        self.state.s[self.InjectEnd] ^= enc8(omega)
+        self._InjectSegment(X.getBytes(self.Ra - omega), omega)
         return
 
     def Spark(self, eomFlag, l):
-        if(eomFlag):
-            if (l == 0):
-                self.state.s[self.EOM] ^= enc8(255)
-            else:
-                self.state.s[self.EOM] ^= enc8(l)
-        else:
-            self.state.s[self.EOM] ^= enc8(0)
+        self._PrepareSpark(eomFlag, l).permute()
+        return
+
+    # Get an independent copy of the piston
+    def fork(self):
+        return Piston(self)
+
+    # Take a snapshot of the piston state (an independent copy) that can be restored later
+    def snapshot(self):
+        return self.fork()
 
-        self.state.s = self.f.apply(self.state.s)
+    # Restore the state of a snapshot (which remains usable)
+    def restore(self, snapshot):
+        self.state = snapshot.state.copy()
         return
 
     def GetTag(self, T, l):
         if (l > self.Rs):
             raise Exception("The requested tag is too long.")
-        for i in xrange(l):
-            T.put(self.state.s[i])
+        T.putBytes(self.state.readBytes(0, l))
         return
 
+    # 'Protected' methods
+    # XOR a segment x followed by the bytes suffix (of at most Ra-omega bytes in total) into the state at offset omega,
+    # or after the first skip bytes of the segment if these are in the state already
+    def _InjectSegment(self, x, omega, suffix = (), skip = 0):
+        self.state.xorByte(self.InjectStart, enc8(omega))
+        omega += skip
+        end = (omega + len(x))
+        self.state.xorBytes(omega, x)
+        for b in suffix:
+            self.state.xorByte(end, b)
+            end += 1
+        self.state.xorByte(self.InjectEnd, enc8(end))
+        return
+
+    # Apply the EOM byte of a Spark and return the state that is to be permuted
+    def _PrepareSpark(self, eomFlag, l):
+        if(eomFlag):
+            if (l == 0):
+                self.state.xorByte(self.EOM, enc8(255))
+            else:
+                self.state.xorByte(self.EOM, enc8(l))
+        else:
+            self.state.xorByte(self.EOM, enc8(0))
+        return self.state
+
 # Engine class
+# Methods that Spark are implemented as generators ("steps") yielding the list of
+# states to permute at every Spark, which allows several engines to be advanced
+# in lockstep and permuted in a single batch. The public methods run them directly.
 class Engine(object):
     def __init__(self, aPistons):
         self.Pi = len(aPistons)
@@ -141,6 +299,48 @@ class Engine(object):
         return
 
     def Inject(self, A):
+        self._Run(self._InjectSteps(A))
+        return
+
+    # Get an independent copy of the engine and its pistons
+    def fork(self):
+        other = shallowCopy(self)
+        _StripInstrumentation(other)
+        other.Pistons = [Piston(piston) for piston in self.Pistons]
+        other.Et = list(self.Et)
+        return other
+
+    # Take a snapshot of the engine (an independent copy) that can be restored later
+    def snapshot(self):
+        return self.fork()
+
+    # Restore the piston states, phase and Et of a snapshot (which remains usable)
+    def restore(self, snapshot):
+        for i in xrange(self.Pi):
+            self.Pistons[i].restore(snapshot.Pistons[i])
+        self.phase = snapshot.phase
+        self.Et = list(snapshot.Et)
+        return
+
+    # Get the state of piston i as bytes
+    def getState(self, i):
+        return self.Pistons[i].state.getBytes()
+
+    # Set the state of piston i from bytes
+    def setState(self, i, s):
+        self.Pistons[i].state.setBytes(s)
+        return
+
+    def GetTags(self, T, l):
+        self._Run(self._GetTagsSteps(T, l))
+        return
+
+    def InjectCollective(self, X, diversifyFlag):
+        self._Run(self._InjectCollectiveSteps(X, diversifyFlag))
+        return
+
+    # 'Protected' methods
+    def _InjectSteps(self, A):
         if ((self.phase != EnginePhase.fresh) and (self.phase != EnginePhase.crypted) and (self.phase != EnginePhase.endOfCrypt)):
             raise Exception("The phase must be fresh, crypted or endOfCrypt to call Engine.Inject().")
 
@@ -150,66 +350,277 @@ class Engine(object):
             self.Pistons[i].Inject(A, cryptingFlag)
 
         if((self.phase == EnginePhase.crypted) or (hasMore(A))):
-            self._Spark(False, [0x00]*self.Pi)
+            yield self._PrepareSpark(False, [0x00]*self.Pi)
             self.phase = EnginePhase.fresh
         else:
             self.phase = EnginePhase.endOfMessage
-        return
 
-    def GetTags(self, T, l):
+    def _GetTagsSteps(self, T, l):
         if (self.phase != EnginePhase.endOfMessage):
             raise Exception("The phase must be endOfMessage to call Engine.GetTags().")
-        self._Spark(True, l)
+        yield self._PrepareSpark(True, l)
 
         for i in xrange(self.Pi):
             self.Pistons[i].GetTag(T, l[i])
 
         self.phase = EnginePhase.fresh
-        return
 
-    def InjectCollective(self, X, diversifyFlag):
+    # The input is read once and injected into every piston from the same view; the diversifier (Pi, i) that
+    # follows it for piston i is injected as a suffix of the block it falls in instead of being appended to a copy.
+    # The input may be preceded by skip bytes (fewer than Ra) that are in the states already, see Motorist.StartEngineFrom().
+    def _InjectCollectiveSteps(self, X, diversifyFlag, skip = 0):
         if (self.phase != EnginePhase.fresh):
             raise Exception("The phase must be fresh to call Engine.InjectCollective().")
 
-        Xt = [stringStream() for i in range(self.Pi)]
-        while (hasMore(X)):
-            x = X.get()
-            for i in xrange(self.Pi):
-                Xt[i].put(x)
-
+        x = self._SegmentView(X.getBytes())
+        n = (skip + len(x))
         if (diversifyFlag):
+            diversifiers = [bytearray([enc8(self.Pi), enc8(i)]) for i in xrange(self.Pi)]
+            length = (n + 2)
+        else:
+            diversifiers = [bytearray()]*self.Pi
+            length = n
+
+        Ra = self.Pistons[0].Ra
+        offset = 0
+        while (offset < length):
+            end = min(offset + Ra, length)
+            first = max(offset, skip)
+            segment = x[(first-skip):(end-skip)]
+            # Part of the diversifiers in this block
+            (start, stop) = ((max(offset, n) - n), max(end - n, 0))
             for i in xrange(self.Pi):
-                Xt[i].put(enc8(self.Pi))
-                Xt[i].put(enc8(i))
+                self._InjectSegment(i, segment, False, diversifiers[i][start:stop], (first - offset))
+            offset = end
+            if (offset < length):
+                yield self._PrepareSpark(False, [0x00]*self.Pi)
 
-        for i in xrange(self.Pi):
-            Xt[i].seek(0, 0)
+        self.phase = EnginePhase.endOfMessage
 
-        while(hasMore(Xt[0])):
+    # Inject the metadata x (bytes) of a message without plaintext, in blocks of Ra bytes per piston. Equivalent
+    # to calling Inject until the metadata is consumed, without its per-block phase checks and stream probes.
+    def _InjectMetadataSteps(self, x):
+        if (self.phase != EnginePhase.fresh):
+            raise Exception("The phase must be fresh to inject metadata only.")
+
+        # Injecting nothing leaves the states unchanged
+        Ra = self.Pistons[0].Ra
+        x = self._SegmentView(x)
+        offset = 0
+        while (offset < len(x)):
             for i in xrange(self.Pi):
-                self.Pistons[i].Inject(Xt[i], 0)
-            if (hasMore(Xt[0])):
-                self._Spark(False, [0x00]*self.Pi)
+                segment = x[offset+i*Ra:offset+(i+1)*Ra]
+                if (len(segment) > 0):
+                    self._InjectSegment(i, segment, False)
+                else:
+                    # Pistons past the end of the metadata inject an empty segment, which changes nothing
+                    break
+            offset += (self.Pi * Ra)
+            if (offset < len(x)):
+                yield self._PrepareSpark(False, [0x00]*self.Pi)
 
         self.phase = EnginePhase.endOfMessage
+
+    # View of the bytes x whose slices are segments that can be injected without copying them
+    def _SegmentView(self, x):
+        return memoryview(x)
+
+    # XOR a segment followed by the bytes suffix, of at most Ra (or Ra-Rs when crypting) bytes in total, into the
+    # state of piston i, after the first skip bytes of the segment if these are in the state already
+    def _InjectSegment(self, i, x, cryptingFlag, suffix = (), skip = 0):
+        if(cryptingFlag):
+            omega = self.Pistons[i].Rs
+        else:
+            omega = 0
+        self.Pistons[i]._InjectSegment(x, omega, suffix, skip)
         return
 
-    # 'Protected' methods
     def _Spark(self, eomFlag, l):
-        for i in xrange(self.Pi):
-            self.Pistons[i].Spark(eomFlag, l[i])
+        State.permuteAll(self._PrepareSpark(eomFlag, l))
+        return
+
+    def _PrepareSpark(self, eomFlag, l):
+        states = [self.Pistons[i]._PrepareSpark(eomFlag, l[i]) for i in xrange(self.Pi)]
         self.Et = l
+        return states
+
+    # Run steps, permuting the yielded states immediately (the states of all pistons as one batch)
+    def _Run(self, steps):
+        for states in steps:
+            State.permuteAll(states)
+        return
+
+# VectorEngine class
+# Engine backend keeping the states of all pistons in one contiguous (Pi, 25) NumPy lane array.
+# Crypt and Inject operate on whole piston segments and Spark permutes all pistons at once.
+# Requires NumPy and a permutation with lanes of 8, 16, 32 or 64 bits.
+class VectorEngine(Engine):
+    def __init__(self, aPistons):
+        super(VectorEngine, self).__init__(aPistons)
+        piston = aPistons[0]
+        self.f = piston.f
+        self.Rs = piston.Rs
+        self.Ra = piston.Ra
+        self.EOM = piston.EOM
+        self.CryptEnd = piston.CryptEnd
+        self.InjectStart = piston.InjectStart
+        self.InjectEnd = piston.InjectEnd
+
+        # Lanes are stored little-endian so that the byte view matches the state layout
+        self.lanes = numpy.zeros((self.Pi, 25), dtype=self.f.laneDtype.newbyteorder('<'))
+        self.s = self.lanes.view(numpy.uint8)
+        for i in xrange(self.Pi):
+            self.s[i] = numpy.frombuffer(bytes(aPistons[i].state.getBytes()), dtype=numpy.uint8)
         return
 
+    # Public methods
+    def Crypt(self, I, O, unwrapFlag):
+        if(self.phase != EnginePhase.fresh):
+            raise Exception("The phase must be fresh to call Engine::Crypt().")
+
+        for i in xrange(self.Pi):
+            omega = self.Et[i]
+            x = numpy.asarray(memoryview(I.getBytes(self.Rs - omega)))
+            end = (omega + len(x))
+            y = (self.s[i, omega:end] ^ x)
+            O.putBytes(y.tostring())
+            if(unwrapFlag):
+                self.s[i, omega:end] = x
+            else:
+                self.s[i, omega:end] = y
+            self.s[i, self.CryptEnd] ^= enc8(end)
+
+        if (hasMore(I)):
+            self.phase = EnginePhase.crypted
+        else:
+            self.phase = EnginePhase.endOfCrypt
+        return
+
+    def fork(self):
+        other = super(VectorEngine, self).fork()
+        other.lanes = self.lanes.copy()
+        other.s = other.lanes.view(numpy.uint8)
+        return other
+
+    def restore(self, snapshot):
+        super(VectorEngine, self).restore(snapshot)
+        self.lanes[...] = snapshot.lanes
+        return
+
+    def getState(self, i):
+        return bytearray(self.s[i].tostring())
+
+    def setState(self, i, s):
+        self.s[i] = numpy.frombuffer(bytes(s), dtype=numpy.uint8)
+        return
+
+    # 'Protected' methods
+    def _InjectSteps(self, A):
+        if ((self.phase != EnginePhase.fresh) and (self.phase != EnginePhase.crypted) and (self.phase != EnginePhase.endOfCrypt)):
+            raise Exception("The phase must be fresh, crypted or endOfCrypt to call Engine.Inject().")
+
+        cryptingFlag = ((self.phase == EnginePhase.crypted) or (self.phase == EnginePhase.endOfCrypt))
+
+        for i in xrange(self.Pi):
+            self._InjectSegment(i, A.getBytes(self.Ra - self.Rs if cryptingFlag else self.Ra), cryptingFlag)
+
+        if((self.phase == EnginePhase.crypted) or (hasMore(A))):
+            yield self._PrepareSpark(False, [0x00]*self.Pi)
+            self.phase = EnginePhase.fresh
+        else:
+            self.phase = EnginePhase.endOfMessage
+
+    def _GetTagsSteps(self, T, l):
+        if (self.phase != EnginePhase.endOfMessage):
+            raise Exception("The phase must be endOfMessage to call Engine.GetTags().")
+        if (max(l) > self.Rs):
+            raise Exception("The requested tag is too long.")
+        yield self._PrepareSpark(True, l)
+
+        for i in xrange(self.Pi):
+            T.putBytes(self.s[i, :l[i]].tostring())
+
+        self.phase = EnginePhase.fresh
+
+    def _InjectCollectiveSteps(self, X, diversifyFlag, skip = 0):
+        if (self.phase != EnginePhase.fresh):
+            raise Exception("The phase must be fresh to call Engine.InjectCollective().")
+
+        # The shared input is XORed into all pistons at once, then the diversifier bytes of every piston
+        x = self._SegmentView(X.getBytes())
+        n = (skip + len(x))
+        if (diversifyFlag):
+            diversifiers = numpy.array([[enc8(self.Pi), enc8(i)] for i in xrange(self.Pi)], dtype=numpy.uint8)
+            length = (n + 2)
+        else:
+            length = n
+
+        offset = 0
+        while (offset < length):
+            end = min(offset + self.Ra, length)
+            # Block positions of the input bytes [first, last) and of the diversifier bytes [last, end)
+            first = max(offset, skip)
+            last = max(min(end, n), first)
+            if (last > first):
+                self.s[:, (first-offset):(last-offset)] ^= x[(first-skip):(last-skip)]
+            if (end > last):
+                self.s[:, (last-offset):(end-offset)] ^= diversifiers[:, (last-n):(end-n)]
+            self.s[:, self.InjectEnd] ^= enc8(end - offset)
+            offset = end
+            if (offset < length):
+                yield self._PrepareSpark(False, [0x00]*self.Pi)
+
+        self.phase = EnginePhase.endOfMessage
+
+    def _SegmentView(self, x):
+        return numpy.asarray(memoryview(x))
+
+    # XOR a segment followed by the bytes suffix, of at most Ra (or Ra-Rs when crypting) bytes in total, into the
+    # state of piston i
+    def _InjectSegment(self, i, x, cryptingFlag, suffix = (), skip = 0):
+        if(cryptingFlag):
+            omega = self.Rs
+        else:
+            omega = 0
+        self.s[i, self.InjectStart] ^= enc8(omega)
+        omega += skip
+        end = (omega + len(x))
+        if not(isinstance(x, numpy.ndarray)):
+            x = numpy.asarray(memoryview(x))
+        self.s[i, omega:end] ^= x
+        for b in suffix:
+            self.s[i, end] ^= b
+            end += 1
+        self.s[i, self.InjectEnd] ^= enc8(end)
+        return
+
+    # All pistons are permuted at once right away, so no states are left for the caller to permute
+    def _PrepareSpark(self, eomFlag, l):
+        if(eomFlag):
+            self.s[:, self.EOM] ^= numpy.array([enc8(255) if (l[i] == 0) else enc8(l[i]) for i in xrange(self.Pi)], dtype=numpy.uint8)
+        self.f.apply_batch(self.lanes)
+        self.Et = l
+        return []
+
 # Motorist class
 class Motorist(object):
+    # Serialization format version and header: version, b, nr, Pi, W, c, tau, Engine.phase, Motorist.phase
+    # (followed by Et as Pi bytes and the Pi piston states of b/8 bytes each)
+    SERIAL_VERSION = 1
+    SERIAL_HEADER = Struct('>BHBBBHHBB')
+
     def __init__(self, aF, aPi, aW, ac, atau):
         self.Pi = aPi
         self.W = aW
         self.c = ac
 
         self.Pistons = [Piston(aF=aF, aRs=(aW/8*((aF.getWidth() - max(ac, 32))/aW)), aRa=(aW/8*((aF.getWidth() - 32)/aW))) for i in xrange(aPi)]
-        self.engine = Engine(self.Pistons)
+        # Multi-piston instances use the vectorized engine whenever NumPy supports the lane size and
+        # the permutation backend is a vectorized one
+        if ((self.Pi > 1) and (numpy != None) and (aF.laneDtype != None) and aF.getBackend().vectorized):
+            self.engine = VectorEngine(self.Pistons)
+        else:
+            self.engine = Engine(self.Pistons)
 
         self.cprime = (aW*((ac + aW - 1)/aW))
 
@@ -222,60 +633,485 @@ class Motorist(object):
         if (self.phase != MotoristPhase.ready):
             raise Exception("The phase must be ready to call Motorist.StartEngine().")
 
-        self.engine.InjectCollective(SUV, True)
+        self.engine._Run(self._StartEngineSteps(SUV, tagFlag, T, unwrapFlag, forgetFlag))
+        return (self.phase == MotoristPhase.riding)
 
-        if (forgetFlag):
-            self._MakeKnot()
-
-        res = self._HandleTag(tagFlag, T, unwrapFlag)
+    # StartEngine with an SUV whose first skip bytes (fewer than Ra) have been absorbed already into the piston
+    # state prepared (e.g. the key pack, see KeyContext), to which all pistons are set; SUV holds the rest of it
+    def StartEngineFrom(self, prepared, skip, SUV, tagFlag, T, unwrapFlag, forgetFlag):
+        if (self.phase != MotoristPhase.ready):
+            raise Exception("The phase must be ready to call Motorist.StartEngineFrom().")
 
-        if (res):
-            self.phase = MotoristPhase.riding
-        return res
+        for i in xrange(self.Pi):
+            self.engine.setState(i, prepared)
+        self.engine._Run(self._StartEngineSteps(SUV, tagFlag, T, unwrapFlag, forgetFlag, skip))
+        return (self.phase == MotoristPhase.riding)
 
+    # I, O and A are streams or sequences of buffers (see bufferListStream), the latter are read and written
+    # in order without being concatenated
     def Wrap(self, I, O, A, T, unwrapFlag, forgetFlag):
         if (self.phase != MotoristPhase.riding):
             raise Exception("The phase must be riding to call Motorist.Wrap().")
 
-        if(not(hasMore(I)) and not(hasMore(A))):
-            self.engine.Inject(A)
+        self.engine._Run(self._WrapSteps(asStream(I), asStream(O), asStream(A), T, unwrapFlag, forgetFlag))
+        return (self.phase != MotoristPhase.failed)
+
+    # Wrap the message I with metadata A (buffers or sequences of buffers), writing the ciphertext into the writable
+    # buffer out (e.g. a bytearray or writable memoryview) at outOffset and the tag into the writable buffer tag at
+    # tagOffset, without intermediate output streams. Returns (number of bytes written to out, True).
+    def wrap_into(self, out, outOffset, I, A, tag, tagOffset, forgetFlag):
+        return self._WrapInto(out, outOffset, I, A, tag, tagOffset, False, forgetFlag)
+
+    # Unwrap the ciphertext C with metadata A and the tag read from tag at tagOffset, writing the plaintext into out at
+    # outOffset. Returns (number of bytes written to out, whether the tag is correct); when it is not, these bytes of
+    # out are zeroed in place.
+    def unwrap_into(self, out, outOffset, C, A, tag, tagOffset, forgetFlag):
+        return self._WrapInto(out, outOffset, C, A, tag, tagOffset, True, forgetFlag)
+
+    # Get an independent copy of the motorist, e.g. to branch a session after StartEngine()
+    def fork(self):
+        other = shallowCopy(self)
+        _StripInstrumentation(other)
+        other.engine = self.engine.fork()
+        other.Pistons = other.engine.Pistons
+        return other
 
-        while (hasMore(I)):
-            self.engine.Crypt(I, O, unwrapFlag)
-            self.engine.Inject(A)
+    # Take a snapshot of the motorist (an independent copy) that can be restored later
+    def snapshot(self):
+        return self.fork()
+
+    # Restore the engine and phase of a snapshot (which remains usable), e.g. to roll back a speculative Wrap()
+    def restore(self, snapshot):
+        self.engine.restore(snapshot.engine)
+        self.phase = snapshot.phase
+        return
+
+    # Start collecting statistics (see Instrumentation), with an optional callback(event, value) hook.
+    # Returns the Instrumentation object. Forks of an instrumented motorist are not instrumented.
+    def enableStats(self, callback = None):
+        self.disableStats()
+        return Instrumentation(self, callback)
+
+    # Stop collecting statistics, after which the motorist runs exactly as if they were never enabled
+    def disableStats(self):
+        if ('_instrumentation' in self.__dict__):
+            self._instrumentation.remove()
+        return
+
+    # Get the statistics collected since enableStats() (a dictionary), or None if they are not enabled
+    def stats(self):
+        if ('_instrumentation' in self.__dict__):
+            return self._instrumentation.stats()
+        return None
+
+    # Size in bytes of the serialized motorist
+    def serializedSize(self):
+        return (self.SERIAL_HEADER.size + self.Pi + self.Pi*self.Pistons[0].state.stateSize)
+
+    # Serialize the motorist (parameters, phases, Et and piston states) into a new bytearray
+    def to_bytes(self):
+        buf = bytearray(self.serializedSize())
+        self.pack_into(buf, 0)
+        return buf
+
+    # Serialize the motorist into a writable buffer (e.g. a bytearray, memoryview or mmap) at offset, without
+    # intermediate copies, and return the number of bytes written
+    def pack_into(self, buf, offset = 0):
+        f = self.Pistons[0].f
+        self.SERIAL_HEADER.pack_into(buf, offset, self.SERIAL_VERSION, f.getWidth(), f.aNrRounds, self.Pi, self.W, self.c, self.tau, self.engine.phase, self.phase)
+        offset += self.SERIAL_HEADER.size
+        buf[offset:offset+self.Pi] = bytearray(self.engine.Et)
+        offset += self.Pi
+        stateSize = self.Pistons[0].state.stateSize
+        for i in xrange(self.Pi):
+            buf[offset:offset+stateSize] = self.engine.getState(i)
+            offset += stateSize
+        return self.serializedSize()
+
+    # Deserialize a motorist from a buffer at offset, on KeccakP[b, nr] unless a permutation aF is given
+    @staticmethod
+    def from_bytes(buf, offset = 0, aF = None):
+        (version, b, nr, Pi, W, c, tau, enginePhase, motoristPhase) = Motorist._UnpackHeader(buf, offset)
+        if (aF == None):
+            aF = KeccakP.get(b, nr)
+        motorist = Motorist(aF, Pi, W, c, tau)
+        motorist.unpack_from(buf, offset)
+        return motorist
+
+    # Load the state serialized in a buffer at offset into this motorist, whose parameters must match
+    def unpack_from(self, buf, offset = 0):
+        (version, b, nr, Pi, W, c, tau, enginePhase, motoristPhase) = Motorist._UnpackHeader(buf, offset)
+        f = self.Pistons[0].f
+        if ((b, nr, Pi, W, c, tau) != (f.getWidth(), f.aNrRounds, self.Pi, self.W, self.c, self.tau)):
+            raise Exception("The serialized motorist parameters do not match.")
+        if (len(buf) - offset < self.serializedSize()):
+            raise Exception("The serialized motorist is truncated.")
+        offset += self.SERIAL_HEADER.size
+
+        self.phase = motoristPhase
+        self.engine.phase = enginePhase
+        self.engine.Et = list(bytearray(buf[offset:offset+Pi]))
+        offset += Pi
+        stateSize = self.Pistons[0].state.stateSize
+        for i in xrange(Pi):
+            self.engine.setState(i, buf[offset:offset+stateSize])
+            offset += stateSize
+        return
 
-        while (hasMore(A)):
-            self.engine.Inject(A)
+    # Wrap for several independent motorists in lockstep, with I, O, A and T lists of streams (one per motorist).
+    # All states that Spark at the same step are permuted in a single batch. Returns the list of results.
+    @staticmethod
+    def wrap_many(motorists, I, O, A, T, unwrapFlag, forgetFlag):
+        for m in motorists:
+            if (m.phase != MotoristPhase.riding):
+                raise Exception("The phase must be riding to call Motorist.wrap_many().")
+
+        running = [m._WrapSteps(asStream(I[i]), asStream(O[i]), asStream(A[i]), T[i], unwrapFlag, forgetFlag) for (i, m) in enumerate(motorists)]
+        while (len(running) > 0):
+            states = []
+            stillRunning = []
+            for steps in running:
+                try:
+                    states.extend(next(steps))
+                    stillRunning.append(steps)
+                except StopIteration:
+                    pass
+            State.permuteAll(states)
+            running = stillRunning
+        return [(m.phase != MotoristPhase.failed) for m in motorists]
+
+    # 'Protected' methods
+    @staticmethod
+    def _UnpackHeader(buf, offset):
+        if (len(buf) - offset < Motorist.SERIAL_HEADER.size):
+            raise Exception("The serialized motorist is truncated.")
+        header = Motorist.SERIAL_HEADER.unpack_from(buf, offset)
+        if (header[0] != Motorist.SERIAL_VERSION):
+            raise Exception("Unsupported serialized motorist version %d." % header[0])
+        (version, b, nr, Pi, W, c, tau, enginePhase, motoristPhase) = header
+        widths = [25, 50, 100, 200, 400, 800, 1600]
+        if not((b in widths) and (1 <= nr <= (12 + 2*widths.index(b))) and (Pi >= 1) and (W == max(b/25, 8)) and (c > 0) and (tau > 0) and
+               ((tau % 8) == 0) and (enginePhase <= EnginePhase.endOfMessage) and (motoristPhase <= MotoristPhase.failed)):
+            raise Exception("The serialized motorist header is corrupted.")
+        # Both rates (as computed by the constructor) must hold at least one lane, and the tag must fit in Rs
+        Rs = (W/8*((b - max(c, 32))/W))
+        Ra = (W/8*((b - 32)/W))
+        if ((Rs <= 0) or (Ra <= 0) or ((tau/8) > Rs)):
+            raise Exception("The serialized motorist header is corrupted.")
+        return header
+
+    # Wrap through streams over the regions of out and tag, which are checked to be large enough beforehand so that
+    # the session is never left halfway through a message
+    def _WrapInto(self, out, outOffset, I, A, tag, tagOffset, unwrapFlag, forgetFlag):
+        if (isinstance(I, (list, tuple))):
+            n = sum(len(x) for x in I)
+            I = bufferListStream(I)
+        else:
+            n = len(I)
+            I = bufferStream(I)
+        if (not(isinstance(A, (list, tuple)))):
+            A = bufferStream(A)
+        O = bufferStream(Motorist._Region(out, outOffset, n, True))
+        T = bufferStream(Motorist._Region(tag, tagOffset, (self.tau/8), not(unwrapFlag)))
+        return (n, self.Wrap(I, O, A, T, unwrapFlag, forgetFlag))
+
+    # View of the n bytes of a buffer at offset
+    @staticmethod
+    def _Region(buf, offset, n, writable):
+        if ((offset < 0) or ((len(buf) - offset) < n)):
+            raise Exception("The buffer is too small.")
+        view = memoryview(buf)
+        if (writable and view.readonly):
+            raise Exception("The buffer is not writable.")
+        return view[offset:offset+n]
+
+    # The steps below report their result through self.phase
+    def _StartEngineSteps(self, SUV, tagFlag, T, unwrapFlag, forgetFlag, skip = 0):
+        for states in self.engine._InjectCollectiveSteps(SUV, True, skip):
+            yield states
+
+        if (forgetFlag):
+            for states in self._MakeKnotSteps():
+                yield states
+
+        for states in self._HandleTagSteps(tagFlag, T, unwrapFlag):
+            yield states
+
+        if (self.phase != MotoristPhase.failed):
+            self.phase = MotoristPhase.riding
+
+    def _WrapSteps(self, I, O, A, T, unwrapFlag, forgetFlag):
+        if not(hasMore(I)):
+            # Authenticate-only and empty messages skip the Crypt machinery
+            for states in self.engine._InjectMetadataSteps(A.getBytes()):
+                yield states
+        else:
+            while (hasMore(I)):
+                self.engine.Crypt(I, O, unwrapFlag)
+                for states in self.engine._InjectSteps(A):
+                    yield states
+
+            while (hasMore(A)):
+                for states in self.engine._InjectSteps(A):
+                    yield states
 
         if ((self.Pi > 1) or (forgetFlag)):
-            self._MakeKnot()
+            for states in self._MakeKnotSteps():
+                yield states
 
-        res = self._HandleTag(True, T, unwrapFlag)
+        for states in self._HandleTagSteps(True, T, unwrapFlag):
+            yield states
 
-        if not(res):
+        if (self.phase == MotoristPhase.failed):
             O.erase()
-        return res
 
-    # 'Protected' methods
-    def _MakeKnot(self):
-        Tprime = stringStream()
-        self.engine.GetTags(Tprime, [self.cprime/8]*self.Pi)
+    # The tags of all pistons are gathered into a single buffer of Pi*c'/8 bytes
+    def _MakeKnotSteps(self):
+        Tprime = bufferStream(bytearray(self.Pi*self.cprime/8))
+        for states in self.engine._GetTagsSteps(Tprime, [self.cprime/8]*self.Pi):
+            yield states
         Tprime.seek(0, 0)
-        self.engine.InjectCollective(Tprime, False)
-        return
+        for states in self.engine._InjectCollectiveSteps(Tprime, False):
+            yield states
 
-    def _HandleTag(self, tagFlag, T, unwrapFlag):
-        Tprime = stringStream()
+    def _HandleTagSteps(self, tagFlag, T, unwrapFlag):
+        Tprime = bufferStream()
         if not(tagFlag):
-            self.engine.GetTags(Tprime, [0x00]*self.Pi)
+            for states in self.engine._GetTagsSteps(Tprime, [0x00]*self.Pi):
+                yield states
         else:
             l = [0x00]*self.Pi
             l[0] = (self.tau/8)
-            self.engine.GetTags(Tprime, l)
+            for states in self.engine._GetTagsSteps(Tprime, l):
+                yield states
 
             if not(unwrapFlag):
                 T.setvalue(Tprime.getvalue())
             elif not(constant_time_compare(Tprime.getvalue(), T.getvalue())):
                 self.phase = MotoristPhase.failed
-                return False
-        return True
\ No newline at end of file
+
+    def _MakeKnot(self):
+        self.engine._Run(self._MakeKnotSteps())
+        return
+
+    def _HandleTag(self, tagFlag, T, unwrapFlag):
+        self.engine._Run(self._HandleTagSteps(tagFlag, T, unwrapFlag))
+        return (self.phase != MotoristPhase.failed)
+
+# Instrumentation class
+# Opt-in statistics on a motorist and its engine. While enabled, instrumented versions of the engine and
+# motorist methods are set as instance attributes that shadow the class methods; disabled motorists only
+# run the class methods, so instrumentation costs nothing unless it is enabled. Collected:
+#   permutations: number of permutations (Pi per Spark)
+#   sparks: number of Sparks by cause: crypt (after crypting a block), metadata (injecting metadata
+#           without crypting), collective (StartEngine and knots) and tag (tags and knots)
+#   bytesCrypted, bytesInjected, bytesInjectedCollective: bytes processed (over all pistons)
+#   bytesPerSpark: histogram {bytes: count} of the bytes crypted and injected per crypt or metadata Spark
+#   knots, tags, tagFailures: knots made, tags generated or verified, and failed verifications
+#   enginePhaseTime, motoristPhaseTime: seconds spent in engine and motorist operations by phase at entry
+#   (engine operations exclude permutations) and permutationTime: seconds spent permuting
+# The callback, if any, is called as callback(event, value) with events 'spark' ((cause, bytes)), 'knot'
+# (None), 'tag' (whether it is correct) and 'call' ((method name, phase name, seconds)).
+class Instrumentation(object):
+    enginePhaseNames = ['fresh', 'crypted', 'endOfCrypt', 'endOfMessage']
+    motoristPhaseNames = ['ready', 'riding', 'failed']
+
+    def __init__(self, motorist, callback = None):
+        self.motorist = motorist
+        self.engine = motorist.engine
+        self.callback = callback
+        self.reset()
+        self._Install()
+        return
+
+    # Public methods
+    def stats(self):
+        result = dict(self.counters)
+        result['sparks'] = dict(self.counters['sparks'])
+        result['bytesPerSpark'] = dict(self.counters['bytesPerSpark'])
+        result['enginePhaseTime'] = dict((self.enginePhaseNames[k], v) for (k, v) in self.counters['enginePhaseTime'].items())
+        result['motoristPhaseTime'] = dict((self.motoristPhaseNames[k], v) for (k, v) in self.counters['motoristPhaseTime'].items())
+        return result
+
+    def reset(self):
+        self.counters = {'permutations': 0, 'sparks': {'crypt': 0, 'metadata': 0, 'collective': 0, 'tag': 0},
+                         'bytesCrypted': 0, 'bytesInjected': 0, 'bytesInjectedCollective': 0, 'bytesPerSpark': {},
+                         'knots': 0, 'tags': 0, 'tagFailures': 0, 'enginePhaseTime': {}, 'motoristPhaseTime': {}, 'permutationTime': 0.0}
+        self.pendingCrypt = 0
+        return
+
+    # Remove the instrumented methods
+    def remove(self):
+        _StripInstrumentation(self.engine)
+        _StripInstrumentation(self.motorist)
+        self.motorist.__dict__.pop('_instrumentation', None)
+        return
+
+    # 'Protected' methods
+    def _Install(self):
+        engine = self.engine
+        motorist = self.motorist
+        methods = {'Crypt': self._Crypt(engine.Crypt),
+                   '_InjectSteps': self._InjectSteps(engine._InjectSteps),
+                   '_InjectMetadataSteps': self._InjectMetadataSteps(engine._InjectMetadataSteps),
+                   '_InjectCollectiveSteps': self._InjectCollectiveSteps(engine._InjectCollectiveSteps),
+                   '_GetTagsSteps': self._Steps(engine._GetTagsSteps, 'tag'),
+                   '_PrepareSpark': self._PrepareSpark(engine._PrepareSpark),
+                   '_Run': self._Run()}
+        engine.__dict__.update(methods)
+        engine._instrumented = list(methods)
+
+        methods = {'StartEngine': self._Call(motorist.StartEngine, 'StartEngine'),
+                   'StartEngineFrom': self._Call(motorist.StartEngineFrom, 'StartEngine'),
+                   'Wrap': self._Call(motorist.Wrap, 'Wrap'),
+                   '_MakeKnotSteps': self._MakeKnotSteps(motorist._MakeKnotSteps),
+                   '_HandleTagSteps': self._HandleTagSteps(motorist._HandleTagSteps)}
+        motorist.__dict__.update(methods)
+        motorist._instrumented = (list(methods) + ['_instrumentation'])
+        motorist._instrumentation = self
+        return
+
+    def _Notify(self, event, value):
+        if (self.callback != None):
+            self.callback(event, value)
+        return
+
+    def _AddTime(self, table, phase, elapsed):
+        table[phase] = (table.get(phase, 0.0) + elapsed)
+        return
+
+    def _Spark(self, cause, n):
+        self.counters['sparks'][cause] += 1
+        if (n != None):
+            histogram = self.counters['bytesPerSpark']
+            histogram[n] = (histogram.get(n, 0) + 1)
+        self._Notify('spark', (cause, n))
+        return
+
+    def _Crypt(self, crypt):
+        def Crypt(I, O, unwrapFlag):
+            phase = self.engine.phase
+            start = time.time()
+            position = I.tell()
+            crypt(I, O, unwrapFlag)
+            n = (I.tell() - position)
+            self.counters['bytesCrypted'] += n
+            self.pendingCrypt += n
+            self._AddTime(self.counters['enginePhaseTime'], phase, time.time() - start)
+            return
+        return Crypt
+
+    # Run the steps of an engine operation, timing them (but not the permutations of the states they yield)
+    def _TimedSteps(self, steps, phase):
+        while True:
+            start = time.time()
+            permutationTime = self.counters['permutationTime']
+            try:
+                states = next(steps)
+            except StopIteration:
+                states = None
+            elapsed = ((time.time() - start) - (self.counters['permutationTime'] - permutationTime))
+            self._AddTime(self.counters['enginePhaseTime'], phase, elapsed)
+            if (states == None):
+                return
+            yield states
+
+    def _Steps(self, method, cause):
+        def Steps(*args):
+            for states in self._TimedSteps(method(*args), self.engine.phase):
+                self._Spark(cause, None)
+                yield states
+        return Steps
+
+    def _InjectSteps(self, method):
+        def InjectSteps(A):
+            phase = self.engine.phase
+            if ((phase == EnginePhase.crypted) or (phase == EnginePhase.endOfCrypt)):
+                cause = 'crypt'
+            else:
+                cause = 'metadata'
+            position = A.tell()
+            for states in self._TimedSteps(method(A), phase):
+                n = (A.tell() - position)
+                self.counters['bytesInjected'] += n
+                self._Spark(cause, self.pendingCrypt + n)
+                self.pendingCrypt = 0
+                position = A.tell()
+                yield states
+            self.counters['bytesInjected'] += (A.tell() - position)
+        return InjectSteps
+
+    def _InjectMetadataSteps(self, method):
+        def InjectMetadataSteps(x):
+            blockSize = (self.engine.Pi * self.engine.Pistons[0].Ra)
+            self.counters['bytesInjected'] += len(x)
+            for states in self._TimedSteps(method(x), self.engine.phase):
+                self._Spark('metadata', blockSize)
+                yield states
+        return InjectMetadataSteps
+
+    def _InjectCollectiveSteps(self, method):
+        def InjectCollectiveSteps(X, diversifyFlag, skip = 0):
+            position = X.tell()
+            for states in self._TimedSteps(method(X, diversifyFlag, skip), self.engine.phase):
+                self._Spark('collective', None)
+                yield states
+            self.counters['bytesInjectedCollective'] += (self.engine.Pi * (X.tell() - position))
+        return InjectCollectiveSteps
+
+    def _PrepareSpark(self, prepareSpark):
+        def PrepareSpark(eomFlag, l):
+            self.counters['permutations'] += self.engine.Pi
+            start = time.time()
+            states = prepareSpark(eomFlag, l)
+            # VectorEngine permutes right away and leaves no states to permute
+            if (len(states) == 0):
+                self.counters['permutationTime'] += (time.time() - start)
+            return states
+        return PrepareSpark
+
+    def _Run(self):
+        def Run(steps):
+            for states in steps:
+                start = time.time()
+                State.permuteAll(states)
+                self.counters['permutationTime'] += (time.time() - start)
+            return
+        return Run
+
+    def _Call(self, method, name):
+        def Call(*args):
+            phase = self.motorist.phase
+            start = time.time()
+            res = method(*args)
+            elapsed = (time.time() - start)
+            self._AddTime(self.counters['motoristPhaseTime'], phase, elapsed)
+            self._Notify('call', (name, self.motoristPhaseNames[phase], elapsed))
+            return res
+        return Call
+
+    def _MakeKnotSteps(self, method):
+        def MakeKnotSteps():
+            self.counters['knots'] += 1
+            self._Notify('knot', None)
+            for states in method():
+                yield states
+        return MakeKnotSteps
+
+    def _HandleTagSteps(self, method):
+        def HandleTagSteps(tagFlag, T, unwrapFlag):
+            for states in method(tagFlag, T, unwrapFlag):
+                yield states
+            if (tagFlag):
+                correct = (self.motorist.phase != MotoristPhase.failed)
+                self.counters['tags'] += 1
+                if not(correct):
+                    self.counters['tagFailures'] += 1
+                self._Notify('tag', correct)
+        return HandleTagSteps
+
+# Remove the instrumented methods set on an object (or on its shallow copy) by Instrumentation
+def _StripInstrumentation(obj):
+    for name in obj.__dict__.pop('_instrumented', ()):
+        obj.__dict__.pop(name, None)
+    return
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Framed Keyak records for event-driven servers
+#
+# A record is framed as: metadata length (4 bytes, big-endian) | message length (4 bytes, big-endian) |
+# metadata | ciphertext | tag. RecordWriter wraps messages into records and passes them to a write
+# callable (e.g. a transport's write method), RecordReader is fed received bytes and unwraps every
+# complete record. Neither blocks on I/O, so both can be driven by any event loop.
+#
+# Messages of at least offloadThreshold bytes are (un)wrapped on an executor (any object with
+# apply_async(func, args, callback=...), such as multiprocessing.pool.ThreadPool) instead of on the
+# event loop thread. As a session is sequential, records are processed one at a time in order and
+# later records wait for offloaded ones. Completions are handed back to the event loop through
+# callSoon (e.g. a loop's call_soon_threadsafe or a reactor's callFromThread).
+#
+# Backpressure is based on the number of message bytes waiting to be (un)wrapped: once it reaches
+# highWater, pause() is called (e.g. to stop reading from the peer), and resume() is called again once
+# it has dropped to lowWater.
+#
+# The lengths in a received frame header are not authenticated until the tag of the record is checked,
+# so a RecordReader only buffers records of up to maxRecordSize bytes of metadata and message. A header
+# announcing a larger record fails the reader like an incorrect tag, and the rest of the input is ignored.
+
+from collections import deque
+from struct import Struct
+import threading
+
+from utils import *
+
+FRAME_HEADER = Struct('>II')
+DEFAULT_MAX_RECORD_SIZE = (1 << 24)
+
+# Shared machinery of RecordWriter and RecordReader
+class _RecordProcessor(object):
+    def __init__(self, keyak, forgetFlag, executor, offloadThreshold, callSoon, highWater, lowWater, pause, resume):
+        self.keyak = keyak
+        self.forgetFlag = forgetFlag
+        self.executor = executor
+        self.offloadThreshold = offloadThreshold
+        self.callSoon = callSoon
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.pause = pause
+        self.resume = resume
+
+        self.queue = deque()
+        self.busy = False
+        self.pendingBytes = 0
+        self.paused = False
+        self.lock = threading.Lock()
+        return
+
+    # Public methods
+    # Number of message bytes waiting to be processed
+    def pending(self):
+        return self.pendingBytes
+
+    # Whether more records should be submitted
+    def writable(self):
+        return (self.pendingBytes < self.highWater)
+
+    # 'Protected' methods
+    # Queue a job (message, metadata, tag) and process it when all jobs before it are done
+    def _enqueue(self, job):
+        with self.lock:
+            self.queue.append(job)
+            self.pendingBytes += len(job[0])
+            pause = (not(self.paused) and (self.pendingBytes >= self.highWater))
+            if (pause):
+                self.paused = True
+        if (pause and (self.pause != None)):
+            self.pause()
+        self._next()
+        return
+
+    def _next(self):
+        while True:
+            with self.lock:
+                if (self.busy or (len(self.queue) == 0)):
+                    return
+                job = self.queue.popleft()
+                self.busy = True
+
+            if ((self.executor != None) and (len(job[0]) >= self.offloadThreshold)):
+                self.executor.apply_async(self._process, job, callback=self._offloaded)
+                return
+            self._done(self._process(*job))
+
+    def _offloaded(self, result):
+        if (self.callSoon != None):
+            self.callSoon(self._finish, result)
+        else:
+            self._finish(result)
+        return
+
+    def _finish(self, result):
+        self._done(result)
+        self._next()
+        return
+
+    def _done(self, result):
+        with self.lock:
+            self.busy = False
+            self.pendingBytes -= result[0]
+            resume = (self.paused and (self.pendingBytes <= self.lowWater))
+            if (resume):
+                self.paused = False
+        self._deliver(*result[1:])
+        if (resume and (self.resume != None)):
+            self.resume()
+        return
+
+# RecordWriter class
+# Wraps messages into records, calling write(record) for each of them in order
+class RecordWriter(_RecordProcessor):
+    def __init__(self, keyak, write, forgetFlag = False, executor = None, offloadThreshold = 65536, callSoon = None, highWater = (1 << 20), lowWater = (1 << 18), pause = None, resume = None):
+        super(RecordWriter, self).__init__(keyak, forgetFlag, executor, offloadThreshold, callSoon, highWater, lowWater, pause, resume)
+        self.write = write
+        return
+
+    # Public methods
+    def send(self, message, metadata = ""):
+        self._enqueue((message, metadata))
+        return
+
+    # 'Protected' methods
+    def _process(self, message, metadata):
+        O = bufferStream()
+        T = bufferStream()
+        self.keyak.Wrap(bufferStream(message), O, bufferStream(metadata), T, False, self.forgetFlag)
+        return (len(message), FRAME_HEADER.pack(len(metadata), len(message)) + metadata + O.getvalue() + T.getvalue())
+
+    def _deliver(self, record):
+        self.write(record)
+        return
+
+# RecordReader class
+# Unwraps the records fed to it, calling onRecord(metadata, plaintext) for each of them in order.
+# When a tag is incorrect onError(metadata) is called instead, after which the session is unusable.
+# When a record is larger than maxRecordSize, onError(None) is called once the records before it are done.
+class RecordReader(_RecordProcessor):
+    def __init__(self, keyak, onRecord, onError, forgetFlag = False, executor = None, offloadThreshold = 65536, callSoon = None, highWater = (1 << 20), lowWater = (1 << 18), pause = None, resume = None, maxRecordSize = DEFAULT_MAX_RECORD_SIZE):
+        super(RecordReader, self).__init__(keyak, forgetFlag, executor, offloadThreshold, callSoon, highWater, lowWater, pause, resume)
+        self.onRecord = onRecord
+        self.onError = onError
+        self.tagSize = (keyak.tau / 8)
+        self.maxRecordSize = maxRecordSize
+        self.buffer = bytearray()
+        # Set once a frame header is rejected, after which input is ignored
+        self.rejected = False
+        self.failed = False
+        return
+
+    # Public methods
+    # Feed received bytes, all complete records are unwrapped
+    def feed(self, data):
+        if (self.rejected):
+            return
+        self.buffer += data
+        while (len(self.buffer) >= FRAME_HEADER.size):
+            (aLen, mLen) = FRAME_HEADER.unpack_from(self.buffer)
+            if ((aLen + mLen) > self.maxRecordSize):
+                self.rejected = True
+                self.buffer = bytearray()
+                # Queued as a record without tag, which fails in order
+                self._enqueue(("", None, None))
+                break
+            end = (FRAME_HEADER.size + aLen + mLen + self.tagSize)
+            if (len(self.buffer) < end):
+                break
+            record = str(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end]
+            self._enqueue((record[aLen:aLen+mLen], record[:aLen], record[aLen+mLen:]))
+        return
+
+    # 'Protected' methods
+    def _process(self, ciphertext, metadata, tag):
+        if (self.failed or (tag == None)):
+            return (len(ciphertext), metadata, None, False)
+        O = bufferStream()
+        res = self.keyak.Wrap(bufferStream(ciphertext), O, bufferStream(metadata), bufferStream(tag), True, self.forgetFlag)
+        return (len(ciphertext), metadata, O.getvalue(), res)
+
+    def _deliver(self, metadata, plaintext, res):
+        if (res):
+            self.onRecord(metadata, plaintext)
+        elif not(self.failed):
+            self.failed = True
+            self.onError(metadata)
+        return
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Parallel replay of the test vector files written by sanity_test.py
+#
+# The files are parsed as a stream into sessions: a "***" instance line, a StartEngine record and the Wrap
+# records that follow it. Sessions are replayed on a process pool (every record is wrapped, then unwrapped
+# again on a second session as sanity_test.py does) and checked against the recorded outputs, in file
+# order, stopping at the first record that diverges. The global tag at the end of every file is checked
+# as well, unless --no-global-tag is given.
+#
+# Example: python replay.py -i LakeKeyak -j 4, or python replay.py TestVectors/RiverKeyak.txt
+
+import os
+import re
+import sys
+import argparse
+from multiprocessing import Pool, cpu_count
+
+from keyak import *
+
+VECTORS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestVectors")
+INSTANCES = ["RiverKeyak", "LakeKeyak", "SeaKeyak", "OceanKeyak", "LunarKeyak"]
+
+INSTANCE_LINE = re.compile(r"^\*\*\* Keyak\[b=(\d+), nr=(\d+), Pi=(\d+), c=(\d+), tau=(\d+)\]$")
+START_ENGINE_LINE = re.compile(r"^StartEngine\(K, N, tagFlag=(True|False), T, unwrapFlag=False, forgetFlag=(True|False)\), with:$")
+WRAP_LINE = re.compile(r"^Wrap\(I, O, A, T, unwrapFlag=false, forgetFlag=(True|False)\), with:$")
+VALUE_LINE = re.compile(r"^([<>]) ([^:]+): \[([0-9a-f]*)\]$")
+GLOBAL_TAG_LINE = re.compile(r"^\+\+\+ Global tag: \[([0-9a-f]*)\]$")
+
+# Session class
+# A StartEngine record and the Wrap records following it. Records are dictionaries with their
+# line number ('line'), flags and the values of their "> " and "< " lines by name.
+class Session(object):
+    def __init__(self, line, parameters):
+        self.line = line
+        self.parameters = parameters
+        self.records = []
+        return
+
+# Parse a vector file as a stream, yielding Session objects and, at the end, ('global tag', line, tag)
+def parseVectors(f):
+    session = None
+    record = None
+    for (number, line) in enumerate(f, 1):
+        line = line.rstrip("\r\n")
+        if (line == ""):
+            continue
+
+        m = INSTANCE_LINE.match(line)
+        if (m != None):
+            if (session != None):
+                yield session
+            session = Session(number, tuple(int(x) for x in m.groups()))
+            record = None
+            continue
+
+        m = GLOBAL_TAG_LINE.match(line)
+        if (m != None):
+            if (session != None):
+                yield session
+            session = None
+            yield ('global tag', number, m.group(1).decode('hex'))
+            continue
+
+        if (session == None):
+            raise Exception("Line %d: record outside of a session." % number)
+
+        m = START_ENGINE_LINE.match(line)
+        if (m != None):
+            record = {'line': number, 'op': 'StartEngine', 'tagFlag': (m.group(1) == "True"), 'forgetFlag': (m.group(2) == "True")}
+            session.records.append(record)
+            continue
+
+        m = WRAP_LINE.match(line)
+        if (m != None):
+            record = {'line': number, 'op': 'Wrap', 'forgetFlag': (m.group(1) == "True")}
+            session.records.append(record)
+            continue
+
+        m = VALUE_LINE.match(line)
+        if ((m == None) or (record == None)):
+            raise Exception("Line %d: cannot parse %r." % (number, line))
+        record[m.group(2)] = m.group(3).decode('hex')
+
+    if (session != None):
+        yield session
+    return
+
+# Replay a session, returns None if it matches the recorded values, or a description of the first
+# diverging record as (line, operation, field, expected, actual)
+def replaySession(session):
+    (b, nr, Pi, c, tau) = session.parameters
+    wrap = Keyak.new(b, nr, Pi, c, tau)
+    unwrap = Keyak.new(b, nr, Pi, c, tau)
+    for record in session.records:
+        forgetFlag = record['forgetFlag']
+        if (record['op'] == 'StartEngine'):
+            tagFlag = record['tagFlag']
+            T = bufferStream()
+            if not(wrap.StartEngine(record['K'], record['N'], tagFlag, T, False, forgetFlag)):
+                return (record['line'], 'StartEngine', 'result', True, False)
+            if (tagFlag and (T.getvalue() != record['T (tag)'])):
+                return (record['line'], 'StartEngine', 'T (tag)', record['T (tag)'], T.getvalue())
+            if not(unwrap.StartEngine(record['K'], record['N'], tagFlag, bufferStream(T.getvalue()), True, forgetFlag)):
+                return (record['line'], 'StartEngine', 'unwrap result', True, False)
+            continue
+
+        O = bufferStream()
+        T = bufferStream()
+        if not(wrap.Wrap(bufferStream(record['I (plaintext)']), O, bufferStream(record['A (metadata)']), T, False, forgetFlag)):
+            return (record['line'], 'Wrap', 'result', True, False)
+        for (field, actual) in [('O (ciphertext)', O.getvalue()), ('T (tag)', T.getvalue())]:
+            if (actual != record[field]):
+                return (record['line'], 'Wrap', field, record[field], actual)
+
+        P = bufferStream()
+        if not(unwrap.Wrap(bufferStream(O.getvalue()), P, bufferStream(record['A (metadata)']), bufferStream(T.getvalue()), True, forgetFlag)):
+            return (record['line'], 'Wrap', 'unwrap result', True, False)
+        if (P.getvalue() != record['I (plaintext)']):
+            return (record['line'], 'Wrap', 'unwrapped plaintext', record['I (plaintext)'], P.getvalue())
+    return None
+
+# Global tag over the recorded outputs, computed as by sanity_test.py
+class GlobalTag(object):
+    def __init__(self, parameters):
+        self.keyak = Keyak.new(*parameters)
+        self.keyak.StartEngine("", "", False, bufferStream(), False, False)
+        return
+
+    def absorb(self, session):
+        for record in session.records:
+            for field in ['O (ciphertext)', 'T (tag)']:
+                if (field in record):
+                    self.keyak.Wrap(bufferStream(), bufferStream(), bufferStream(record[field]), bufferStream(), False, False)
+        return
+
+    def tag(self):
+        T = bufferStream()
+        self.keyak.Wrap(bufferStream(), bufferStream(), bufferStream(), T, False, False)
+        return T.getvalue()
+
+def _replayItem(item):
+    if (isinstance(item, Session)):
+        return replaySession(item)
+    return None
+
+def _parseFile(path):
+    with open(path, 'rb') as f:
+        for item in parseVectors(f):
+            yield item
+
+# Replay a vector file on pool (or in this process if pool is None), returns True if it matches.
+# Reports the result and the first divergence on out.
+def replayFile(path, pool, globalTag = True, out = sys.stdout):
+    if (pool != None):
+        # The file is parsed a second time in this process for the context of the results
+        results = pool.imap(_replayItem, _parseFile(path), 16)
+    else:
+        results = None
+
+    sessions = 0
+    records = 0
+    checksum = None
+    for item in _parseFile(path):
+        if (results != None):
+            divergence = next(results)
+        else:
+            divergence = _replayItem(item)
+
+        if not(isinstance(item, Session)):
+            (op, line, expected) = item
+            if (checksum != None):
+                actual = checksum.tag()
+                if (actual != expected):
+                    out.write("[-] %s:%d: the global tag does not match\n" % (path, line))
+                    out.write("    expected: [%s]\n    actual:   [%s]\n" % (expected.encode('hex'), actual.encode('hex')))
+                    return False
+                checksum = None
+            continue
+
+        if (divergence != None):
+            (line, op, field, expected, actual) = divergence
+            start = item.records[0]
+            out.write("[-] %s:%d: %s record diverges on %s\n" % (path, line, op, field))
+            out.write("    session at line %d: Keyak[b=%d, nr=%d, Pi=%d, c=%d, tau=%d]\n" % ((item.line,) + item.parameters))
+            out.write("    K: [%s]\n    N: [%s]\n" % (start.get('K', '').encode('hex'), start.get('N', '').encode('hex')))
+            if (isinstance(expected, str)):
+                out.write("    expected: [%s]\n    actual:   [%s]\n" % (expected.encode('hex'), actual.encode('hex')))
+            return False
+
+        if (globalTag):
+            if (checksum == None):
+                checksum = GlobalTag(item.parameters)
+            checksum.absorb(item)
+        sessions += 1
+        records += len(item.records)
+
+    out.write("[+] %s: %d sessions, %d records verified\n" % (path, sessions, records))
+    return True
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay and verify the Keyak test vector files.")
+    parser.add_argument("files", nargs="*", help="vector files (all files in TestVectors by default)")
+    parser.add_argument("-i", "--instance", action="append", choices=INSTANCES, help="named instance whose vector file to replay (can be repeated)")
+    parser.add_argument("-j", "--processes", type=int, default=cpu_count(), help="number of worker processes")
+    parser.add_argument("--no-global-tag", action="store_true", help="do not check the global tags")
+    args = parser.parse_args(argv)
+
+    paths = list(args.files)
+    for name in (args.instance or []):
+        paths.append(os.path.join(VECTORS_DIRECTORY, name + ".txt"))
+    if (len(paths) == 0):
+        paths = [os.path.join(VECTORS_DIRECTORY, name + ".txt") for name in INSTANCES if os.path.exists(os.path.join(VECTORS_DIRECTORY, name + ".txt"))]
+
+    pool = None
+    if (args.processes > 1):
+        pool = Pool(args.processes)
+    try:
+        for path in paths:
+            try:
+                if not(replayFile(path, pool, not(args.no_global_tag))):
+                    return 1
+            except Exception as e:
+                sys.stdout.write("[-] %s: %s\n" % (path, e))
+                return 1
+    finally:
+        if (pool != None):
+            pool.terminate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
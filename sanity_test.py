@@ -11,9 +11,31 @@
 # http://keccak.noekeon.org/
 # http://ketje.noekeon.org/
 
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import time
+
+# NumPy is optional, the apply_batch array test is skipped without it
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 from keccakp import *
 from keyak import *
 from utils import *
+from keycache import *
+from streaming import *
+from sessionpool import *
+import container
+from service import *
+from records import *
+from sessions import *
 
 # Generate testing materials
 def generate_simple_raw_material(length, seed1, seed2):
@@ -26,7 +48,7 @@ def generate_simple_raw_material(length, seed1, seed2):
 # Test Keyak engine starting functionality
 def test_keyak_start_engine(gl, wrap, unwrap, fout, K, N, forgetFlag, tagFlag):
 
-	fout.write("*** " + wrap.GetInfo()+"\n")
+	fout.write("*** " + wrap.GetName()+"\n")
 	fout.write("StartEngine(K, N, tagFlag=" + str(tagFlag) + ", T, unwrapFlag=False, forgetFlag=" + str(forgetFlag) + "), with:"+"\n")
 	fout.write("> K: [%s]" % K.encode('hex')+"\n")
 	fout.write("> N: [%s]" % N.encode('hex')+"\n")
@@ -262,11 +284,800 @@ def test_keccakp():
 	# KeccakP permutations for all named instances of Keyak
 	permutations = {800: 12, 1600: 12}
 
-	for b in permutations:
-		f = KeccakP(b, permutations[b])
-		for i in xrange(len(test_vectors[b])-1):			
-			s = f.apply(test_vectors[b][i])
-			assert (s == test_vectors[b][i+1]), ("[-] KeccakP[%d, %d] test vector %d failed" % (b, permutations[b], i))
+	# Test vectors must hold for every permutation backend
+	active = getBackend()
+	for name in backendNames():
+		setBackend(name)
+		for b in permutations:
+			f = KeccakP(b, permutations[b])
+			for i in xrange(len(test_vectors[b])-1):			
+				s = f.apply(test_vectors[b][i])
+				assert (s == test_vectors[b][i+1]), ("[-] KeccakP[%d, %d] (%s backend) test vector %d failed" % (b, permutations[b], name, i))
+				s = bytearray(test_vectors[b][i])
+				f.apply_inplace(s)
+				assert (s == test_vectors[b][i+1]), ("[-] KeccakP[%d, %d] (%s backend) in-place test vector %d failed" % (b, permutations[b], name, i))
+				lanes = f.loadLanes(test_vectors[b][i])
+				f.apply_inplace(lanes)
+				assert (f.storeLanes(lanes) == test_vectors[b][i+1]), ("[-] KeccakP[%d, %d] (%s backend) lane test vector %d failed" % (b, permutations[b], name, i))
+
+			batch = f.apply_batch([f.loadLanes(v) for v in test_vectors[b][:-1]])
+			assert ([f.storeLanes(lanes) for lanes in batch] == list(test_vectors[b][1:])), ("[-] KeccakP[%d, %d] (%s backend) batch test vectors failed" % (b, permutations[b], name))
+	setBackend(active.name)
+	return True
+
+# Cross-check all permutation backends on every width and number of rounds, as lane lists (which
+# every width supports) and as byte states (for widths with lanes of whole bytes)
+def test_keccakp_backends():
+	nominalNrRounds = {25: 12, 50: 14, 100: 16, 200: 18, 400: 20, 800: 22, 1600: 24}
+	active = getBackend()
+	for b in sorted(nominalNrRounds):
+		for nr in xrange(1, nominalNrRounds[b]+1):
+			f = KeccakP(b, nr)
+			lanes = [((i * 0x9e3779b97f4a7c15 + nr) & f.laneMask) for i in xrange(25)]
+			state = bytearray(generate_simple_raw_material(b/8, b+nr, 3))
+			expected = None
+			for name in backendNames():
+				setBackend(name)
+				output = (f.apply_inplace(list(lanes)), (f.apply(state) if ((b % 200) == 0) else None))
+				if (expected == None):
+					expected = (name, output)
+				assert (output == expected[1]), ("[-] KeccakP[%d, %d]: the %s and %s backends differ" % (b, nr, expected[0], name))
+	setBackend(active.name)
+	return True
+
+# Check that apply_batch permutes an (N, 25) NumPy array of lanes in place, also when it has to convert it
+# to the lane type, and that every row matches apply. Skipped (returns False) when NumPy is not installed.
+def test_keccakp_batch_array():
+	if (numpy == None):
+		print "[*] NumPy is not installed, skipping the apply_batch array test"
+		return False
+	active = getBackend()
+	for name in backendNames():
+		setBackend(name)
+		for b in [200, 400, 800, 1600]:
+			f = KeccakP(b, 12)
+			states = [bytearray(generate_simple_raw_material(b/8, b+i, 5)) for i in xrange(5)]
+			expected = [f.loadLanes(f.apply(s)) for s in states]
+			for dtype in [f.laneDtype, numpy.uint64]:
+				lanes = numpy.array([f.loadLanes(s) for s in states], dtype=dtype)
+				result = f.apply_batch(lanes)
+				assert ((result is lanes) and (lanes.dtype == dtype)), ("[-] KeccakP[%d, 12] (%s backend): apply_batch did not permute the %s array in place" % (b, name, numpy.dtype(dtype).name))
+				assert ([[int(x) for x in row] for row in lanes] == expected), ("[-] KeccakP[%d, 12] (%s backend): apply_batch on a %s array differs from apply" % (b, name, numpy.dtype(dtype).name))
+	setBackend(active.name)
+	return True
+
+# Wrap the message P with metadata A on two sessions, check that the ciphertexts, tags and results are equal
+# and return them
+def wrap_both(session, other, P, A, unwrapFlag, forgetFlag, T = ""):
+	outputs = []
+	for s in [session, other]:
+		(O, TT) = (stringStream(), stringStream(T))
+		res = s.Wrap(stringStream(P), O, stringStream(A), TT, unwrapFlag, forgetFlag)
+		outputs.append((res, O.getvalue(), TT.getvalue()))
+	assert (outputs[0] == outputs[1]), ("[-] %s: the sessions wrap differently" % session.GetName())
+	return outputs[0]
+
+# Check the vectorized engine (used by multi-piston instances with the numpy backend) against the
+# reference engine: StartEngine, Wrap and unwrap, fork, snapshot and restore, and serialization.
+# Skipped (returns False) when NumPy is not installed.
+def test_vector_engine():
+	if (numpy == None):
+		print "[*] NumPy is not installed, skipping the vectorized engine test"
+		return False
+	K = generate_simple_raw_material(16, 14, 1)
+	N = generate_simple_raw_material(40, 15, 2)
+	active = getBackend()
+	for newKeyak in [SeaKeyak, OceanKeyak, LunarKeyak]:
+		setBackend('optimized')
+		reference = newKeyak()
+		setBackend('numpy')
+		vector = newKeyak()
+		assert (isinstance(vector.motorist.engine, VectorEngine) and not(isinstance(reference.motorist.engine, VectorEngine))), "[-] %s: unexpected engines" % vector.GetName()
+
+		T = [stringStream(), stringStream()]
+		assert (reference.StartEngine(K, N, True, T[0], False, True) and vector.StartEngine(K, N, True, T[1], False, True)), "[-] %s: StartEngine failed" % vector.GetName()
+		assert (T[0].getvalue() == T[1].getvalue()), "[-] %s: the vectorized engine gives another StartEngine tag" % vector.GetName()
+
+		for (Plen, Alen, forgetFlag) in [(0, 0, False), (1, 30, True), (500, 7, False), (2000, 1000, True)]:
+			P = generate_simple_raw_material(Plen, Plen, 3)
+			A = generate_simple_raw_material(Alen, Alen, 4)
+			(res, C, tag) = wrap_both(reference.fork(), vector.fork(), P, A, False, forgetFlag)
+			wrap_both(reference.fork(), vector.fork(), C, A, True, forgetFlag, tag)
+			wrap_both(reference.fork(), vector.fork(), C, A, True, forgetFlag, "\0"*len(tag))
+			wrap_both(reference, vector, P, A, False, forgetFlag)
+			assert (reference.to_bytes() == vector.to_bytes()), "[-] %s: the vectorized engine serializes another state" % vector.GetName()
+
+		# Forks and restored snapshots are independent of the session they come from
+		fork = vector.fork()
+		snapshot = vector.snapshot()
+		wrap_both(reference.fork(), fork, "forked", "", False, False)
+		wrap_both(reference, vector, "original", "", False, False)
+		vector.restore(snapshot)
+		reference = Keyak.from_bytes(snapshot.to_bytes())
+		assert isinstance(reference.motorist.engine, VectorEngine), "[-] %s: a deserialized session does not use the vectorized engine" % vector.GetName()
+		wrap_both(reference, vector, "restored", "", False, False)
+		setBackend('optimized')
+		reference = Keyak.from_bytes(vector.to_bytes())
+		assert not(isinstance(reference.motorist.engine, VectorEngine)), "[-] %s: a deserialized session kept the vectorized engine" % vector.GetName()
+		wrap_both(reference, vector, "deserialized", "metadata", False, True)
+	setBackend(active.name)
+	return True
+
+# Check StartEngine with cached key contexts against uncached StartEngine, for several key and nonce
+# lengths, with and without tags and forgetting, then LRU eviction and the key digest index
+def test_keycache():
+	instances = [LakeKeyak, SeaKeyak, OceanKeyak, lambda: Keyak(200, 12, 1, 64, 64), lambda: Keyak(400, 12, 2, 128, 64)]
+	cache = KeyCache(2)
+	for newKeyak in instances:
+		lk = newKeyak()._keypackLength()
+		for K in [generate_simple_raw_material(min(16, lk-2), 1, 2), generate_simple_raw_material(lk-2, 2, 3)]:
+			for Nlen in [0, 12, 58, 150]:
+				N = generate_simple_raw_material(Nlen, Nlen, 1)
+				for (tagFlag, forgetFlag) in [(False, False), (True, False), (True, True)]:
+					uncached = newKeyak()
+					cached = newKeyak()
+					T = stringStream()
+					TT = stringStream()
+					rv = uncached.StartEngine(K, N, tagFlag, T, False, forgetFlag)
+					assert ((rv, T.getvalue()) == (cache.StartEngine(cached, K, N, tagFlag, TT, False, forgetFlag), TT.getvalue())), ("[-] %s: cached StartEngine differs for |K|=%d, |N|=%d" % (uncached.GetName(), len(K), Nlen))
+					assert (uncached.to_bytes() == cached.to_bytes()), ("[-] %s: cached StartEngine state differs for |K|=%d, |N|=%d" % (uncached.GetName(), len(K), Nlen))
+
+					P = generate_simple_raw_material(3*Nlen, 5, 4)
+					A = generate_simple_raw_material(Nlen/2, 6, 5)
+					(O, T) = (stringStream(), stringStream())
+					(OO, TT) = (stringStream(), stringStream())
+					uncached.Wrap(stringStream(P), O, stringStream(A), T, False, forgetFlag)
+					cached.Wrap(stringStream(P), OO, stringStream(A), TT, False, forgetFlag)
+					assert ((O.getvalue(), T.getvalue()) == (OO.getvalue(), TT.getvalue())), ("[-] %s: wrapping after cached StartEngine differs" % uncached.GetName())
+
+	# Least recently used contexts are dropped once the capacity is reached
+	cache = KeyCache(2)
+	keyak = LakeKeyak()
+	(K1, K2, K3) = ("key 1", "key 2", "key 3")
+	c1 = cache.get(keyak, K1)
+	cache.get(keyak, K2)
+	assert (cache.get(keyak, K1) is c1), "[-] KeyCache: a cached context was not reused"
+	cache.get(keyak, K3)
+	stats = cache.stats()
+	assert ((stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 3, 1, 2)), "[-] KeyCache: unexpected statistics after an eviction"
+	assert (cache.get(keyak, K1) is c1), "[-] KeyCache: the most recently used context was evicted"
+	cache.get(keyak, K2)
+	assert (cache.stats()['misses'] == 4), "[-] KeyCache: the least recently used context was not evicted"
+	assert (c1.prepared != None), "[-] KeyCache: a context dropped for capacity was zeroized"
+
+	# Contexts are indexed by the SHA-256 digest of the key, and evict() zeroizes all contexts of a key
+	cache = KeyCache()
+	cache.get(LakeKeyak(), K1)
+	c2 = cache.get(RiverKeyak(), K1)
+	cache.get(LakeKeyak(), K2)
+	digest = hashlib.sha256(K1).digest()
+	assert all(((index[1] == hashlib.sha256(K).digest()) and not(K in repr(index))) for (index, K) in zip(cache.contexts.keys(), [K1, K1, K2])), "[-] KeyCache: the index is not a digest of the key"
+	assert (cache.evict(K1) == 2), "[-] KeyCache: evict() did not remove all contexts of the key"
+	assert (all((index[1] != digest) for index in cache.contexts) and (len(cache) == 1)), "[-] KeyCache: evict() removed the wrong contexts"
+	assert ((c2.prepared == None) and (c2.keypack == bytearray(len(c2.keypack)))), "[-] KeyCache: an evicted context was not zeroized"
+	rejected = False
+	try:
+		RiverKeyak().StartEngineWithContext(c2, "nonce", False, stringStream(), False, False)
+	except Exception:
+		rejected = True
+	assert rejected, "[-] KeyCache: a zeroized context was used"
+	return True
+
+# Check that wrap_into and unwrap_into give the same output as Wrap, with buffers and sequences of
+# buffers, and that a failed unwrap_into zeroes the bytes it wrote and nothing else
+def test_wrap_into():
+	K = generate_simple_raw_material(16, 1, 1)
+	N = generate_simple_raw_material(16, 2, 2)
+	for newKeyak in [RiverKeyak, LakeKeyak, SeaKeyak, OceanKeyak]:
+		for (Plen, Alen) in [(0, 0), (0, 30), (1, 0), (100, 7), (500, 400), (1500, 3)]:
+			P = generate_simple_raw_material(Plen, Plen, 3)
+			A = generate_simple_raw_material(Alen, Alen, 4)
+			session = newKeyak()
+			session.StartEngine(K, N, False, stringStream(), False, False)
+			(O, T) = (stringStream(), stringStream())
+			wrap = session.fork()
+			wrap.Wrap(stringStream(P), O, stringStream(A), T, False, False)
+			(C, tag) = (O.getvalue(), T.getvalue())
+
+			# Only the output region and the tag region are written
+			out = bytearray("x"*(Plen + 8))
+			tags = bytearray("y"*(len(tag) + 4))
+			assert (session.fork().wrap_into(out, 3, P, A, tags, 2, False) == (Plen, True)), "[-] %s: wrap_into() failed" % session.GetName()
+			assert ((out == ("xxx" + C + "xxxxx")) and (tags == ("yy" + tag + "yy"))), "[-] %s: wrap_into() differs from Wrap()" % session.GetName()
+
+			out = bytearray(Plen)
+			tags = bytearray(len(tag))
+			session.fork().wrap_into(memoryview(out), 0, [P[:Plen/3], P[Plen/3:Plen/2], P[Plen/2:]], [A[:Alen/2], A[Alen/2:]], tags, 0, False)
+			assert ((out == C) and (tags == tag)), "[-] %s: wrap_into() of sequences of buffers differs from Wrap()" % session.GetName()
+
+			out = bytearray("z"*(Plen + 2))
+			assert (session.fork().unwrap_into(out, 1, C, A, tag, 0, False) == (Plen, True)), "[-] %s: unwrap_into() failed" % session.GetName()
+			assert (out == ("z" + P + "z")), "[-] %s: unwrap_into() did not give the plaintext" % session.GetName()
+
+			badTag = (chr(ord(tag[0]) ^ 1) + tag[1:])
+			out = bytearray("z"*(Plen + 2))
+			assert (session.fork().unwrap_into(out, 1, C, A, badTag, 0, False) == (Plen, False)), "[-] %s: unwrap_into() accepted a wrong tag" % session.GetName()
+			assert (out == ("z" + "\0"*Plen + "z")), "[-] %s: a failed unwrap_into() did not zero exactly its output" % session.GetName()
+	return True
+
+# Check that serialized sessions round-trip in every phase (ready, riding and failed, before and
+# after forgetting) and that truncated or corrupted serializations are rejected
+def test_serialization():
+	K = generate_simple_raw_material(16, 3, 1)
+	N = generate_simple_raw_material(16, 4, 2)
+	P = generate_simple_raw_material(300, 5, 3)
+	A = generate_simple_raw_material(40, 6, 4)
+	for newKeyak in [RiverKeyak, LakeKeyak, SeaKeyak]:
+		ready = newKeyak()
+		riding = newKeyak()
+		riding.StartEngine(K, N, False, stringStream(), False, False)
+		wrapped = riding.fork()
+		(O, T) = (stringStream(), stringStream())
+		wrapped.Wrap(stringStream(P), O, stringStream(A), T, False, True)
+		failed = riding.fork()
+		failed.Wrap(stringStream(O.getvalue()), stringStream(), stringStream(A), stringStream("\0"*len(T.getvalue())), True, True)
+		sessions = [ready, riding, wrapped, failed]
+		assert (sorted(set(s.motorist.phase for s in sessions)) == [MotoristPhase.ready, MotoristPhase.riding, MotoristPhase.failed]), "[-] Not all motorist phases are covered"
+
+		for session in sessions:
+			serialized = session.to_bytes()
+			assert (len(serialized) == session.motorist.serializedSize()), "[-] %s: unexpected serialized size" % session.GetName()
+			copy = Keyak.from_bytes(serialized)
+			assert ((copy.GetName() == session.GetName()) and (copy.to_bytes() == serialized)), "[-] %s: the serialization does not round-trip" % session.GetName()
+
+			buf = bytearray("x"*(len(serialized) + 10))
+			assert (session.pack_into(buf, 7) == len(serialized)), "[-] %s: pack_into() returned a wrong size" % session.GetName()
+			assert ((buf[7:7+len(serialized)] == serialized) and (buf[:7] == "x"*7) and (buf[7+len(serialized):] == "xxx")), "[-] %s: pack_into() wrote out of its record" % session.GetName()
+			target = newKeyak()
+			target.motorist.unpack_from(buf, 7)
+			assert (target.to_bytes() == serialized), "[-] %s: unpack_from() does not round-trip" % session.GetName()
+
+			# A deserialized session carries on as the original one
+			if (session.motorist.phase == MotoristPhase.riding):
+				(O, T) = (stringStream(), stringStream())
+				(OO, TT) = (stringStream(), stringStream())
+				session.fork().Wrap(stringStream(P), O, stringStream(A), T, False, False)
+				target.Wrap(stringStream(P), OO, stringStream(A), TT, False, False)
+				assert ((O.getvalue(), T.getvalue()) == (OO.getvalue(), TT.getvalue())), "[-] %s: a deserialized session wraps differently" % session.GetName()
+
+		# Truncated records are rejected, whether the header or the states are cut
+		serialized = riding.to_bytes()
+		for n in xrange(len(serialized)):
+			for deserialize in [lambda buf: Keyak.from_bytes(buf), lambda buf: newKeyak().motorist.unpack_from(buf)]:
+				rejected = False
+				try:
+					deserialize(serialized[:n])
+				except Exception:
+					rejected = True
+				assert rejected, "[-] %s: a record truncated to %d bytes was accepted" % (riding.GetName(), n)
+
+		# Header fields (version, b, nr, Pi, W, c, tau, Engine.phase, Motorist.phase) set to invalid values are
+		# rejected, and so are valid parameters other than those of the session loading the record
+		header = Motorist.SERIAL_HEADER.unpack_from(serialized, 0)
+		# The lane size must be that of b, and c and tau must leave Rs > 0 with the tag fitting in it
+		Rs = riding.motorist.Pistons[0].Rs
+		invalid = [(0, 0), (0, 2), (1, 0), (1, 1000), (2, 0), (2, 25), (3, 0), (4, 0), (4, 12), (4, 16), (5, 0), (5, 1600), (5, header[1]-1),
+				   (5, header[1]-header[4]+1), (6, 0), (6, 12), (6, 8*(Rs+1)), (7, 4), (8, 3)]
+		mismatched = [(1, 400), (2, 11), (3, 3), (5, 128), (6, 64)]
+		for (field, value) in (invalid + mismatched):
+			fields = list(header)
+			fields[field] = value
+			corrupted = bytearray(serialized)
+			Motorist.SERIAL_HEADER.pack_into(corrupted, 0, *fields)
+			deserializers = [lambda buf: newKeyak().motorist.unpack_from(buf)]
+			if ((field, value) in invalid):
+				deserializers.append(lambda buf: Motorist.from_bytes(buf))
+			for deserialize in deserializers:
+				rejected = False
+				try:
+					deserialize(corrupted)
+				except Exception:
+					rejected = True
+				assert rejected, "[-] %s: a record with header field %d set to %d was accepted" % (riding.GetName(), field, value)
+	return True
+
+# Split s at the given offsets into a list of buffers
+def split_buffers(s, offsets):
+	bounds = ([0] + [o for o in offsets if (0 < o < len(s))] + [len(s)])
+	return [bytearray(s[bounds[i]:bounds[i+1]]) for i in xrange(len(bounds)-1)]
+
+# Check that Wrap on sequences of buffers (scatter-gather input, metadata and output) gives the same
+# ciphertext and tag as Wrap on single buffers, with buffer boundaries on and around multiples of Rs
+def test_scatter_gather():
+	K = generate_simple_raw_material(16, 7, 1)
+	N = generate_simple_raw_material(16, 8, 2)
+	for newKeyak in [RiverKeyak, LakeKeyak, SeaKeyak, OceanKeyak]:
+		session = newKeyak()
+		session.StartEngine(K, N, False, stringStream(), False, False)
+		Rs = session.motorist.Pistons[0].Rs
+		Pi = session.Pi
+		for Plen in [0, 1, Rs, Pi*Rs, 3*Pi*Rs, 3*Pi*Rs + 5]:
+			P = generate_simple_raw_material(Plen, Plen, 5)
+			A = generate_simple_raw_material(2*Rs + 3, Plen, 6)
+			(O, T) = (stringStream(), stringStream())
+			session.fork().Wrap(stringStream(P), O, stringStream(A), T, False, False)
+			C = O.getvalue()
+
+			for offsets in [[Rs], [Rs, 2*Rs, 3*Rs], [Pi*Rs, 2*Pi*Rs], [1, Rs - 1, Rs + 1, 2*Rs], range(0, Plen, 7), [0, 0, Plen]]:
+				I = split_buffers(P, offsets)
+				Ab = split_buffers(A, offsets)
+				Ob = split_buffers("\0"*Plen, offsets)
+				TT = stringStream()
+				assert session.fork().Wrap(I, Ob, Ab, TT, False, False), "[-] %s: scatter-gather Wrap() failed" % session.GetName()
+				assert (("".join(str(b) for b in Ob) == C) and (TT.getvalue() == T.getvalue())), ("[-] %s: scatter-gather Wrap() differs from Wrap() for %d bytes split at %r" % (session.GetName(), Plen, offsets))
+
+				Ob = split_buffers("\0"*Plen, offsets)
+				assert session.fork().Wrap(split_buffers(C, offsets), Ob, Ab, stringStream(T.getvalue()), True, False), "[-] %s: scatter-gather unwrap failed" % session.GetName()
+				assert ("".join(str(b) for b in Ob) == P), "[-] %s: scatter-gather unwrap did not give the plaintext" % session.GetName()
+	return True
+
+# Check that KeyakStream fed in chunks gives the same ciphertext and tag as a single Wrap, with chunk
+# boundaries on and around multiples of Rs, and that it only runs on sessions in the riding phase
+def test_keyak_stream():
+	K = generate_simple_raw_material(16, 9, 1)
+	N = generate_simple_raw_material(16, 10, 2)
+	for newKeyak in [RiverKeyak, LakeKeyak, SeaKeyak, OceanKeyak]:
+		session = newKeyak()
+		rejected = False
+		try:
+			KeyakStream(session, stringStream(), "", False, False).update("data")
+		except Exception:
+			rejected = True
+		assert rejected, "[-] %s: KeyakStream.update() ran on a session that was not started" % session.GetName()
+
+		session.StartEngine(K, N, False, stringStream(), False, False)
+		Rs = session.motorist.Pistons[0].Rs
+		Pi = session.Pi
+		for Plen in [0, 1, Rs, Pi*Rs, 3*Pi*Rs, 3*Pi*Rs + 5]:
+			P = generate_simple_raw_material(Plen, Plen, 7)
+			A = generate_simple_raw_material(Rs + 3, Plen, 8)
+			(O, T) = (stringStream(), stringStream())
+			session.fork().Wrap(stringStream(P), O, stringStream(A), T, False, False)
+			C = O.getvalue()
+
+			for chunkSize in [1, 7, Rs - 1, Rs, Rs + 1, Pi*Rs, 2*Pi*Rs]:
+				O = stringStream()
+				stream = KeyakStream(session.fork(), O, A, False, False)
+				for i in xrange(0, Plen, chunkSize):
+					stream.update(P[i:i+chunkSize])
+				assert ((stream.finalize() == T.getvalue()) and (O.getvalue() == C)), ("[-] %s: KeyakStream in chunks of %d bytes differs from Wrap() for %d bytes" % (session.GetName(), chunkSize, Plen))
+
+				for policy in [UnverifiedPolicy.spool, UnverifiedPolicy.trusted]:
+					O = stringStream()
+					stream = KeyakStream(session.fork(), O, A, True, False, policy)
+					for i in xrange(0, Plen, chunkSize):
+						stream.update(C[i:i+chunkSize])
+					assert (stream.finalize(T.getvalue()) and (O.getvalue() == P)), ("[-] %s: KeyakStream unwrap in chunks of %d bytes failed for %d bytes" % (session.GetName(), chunkSize, Plen))
+
+		# After a failed unwrap the session can no longer be streamed on
+		failed = session.fork()
+		stream = KeyakStream(failed, stringStream(), A, True, False)
+		stream.update(C)
+		assert not(stream.finalize("\0"*len(T.getvalue()))), "[-] %s: KeyakStream accepted a wrong tag" % session.GetName()
+		rejected = False
+		try:
+			KeyakStream(failed, stringStream(), A, False, False).update("data")
+		except Exception:
+			rejected = True
+		assert rejected, "[-] %s: KeyakStream.update() ran on a failed session" % session.GetName()
+	return True
+
+# Check that copies share nothing observable: writes to a copied state, a fork or a restored session do
+# not leak into the original (nor the other way around), and restoring a snapshot twice gives the same output
+def test_copy_on_write():
+	f = KeccakP(1600, 12)
+	for permuted in [False, True]:
+		state = State(200, f)
+		state.xorBytes(3, "initial")
+		if (permuted):
+			# The state is in lane form after a permutation
+			state.permute()
+		original = str(state.copy().getBytes())
+		copy = state.copy()
+		copy.xorBytes(5, "copy")
+		copy.xorByte(150, 0x80)
+		assert (str(state.copy().getBytes()) == original), "[-] State: a write to a copy leaked into the original"
+		state.xorBytes(0, "state")
+		state.permute()
+		assert (copy.readBytes(5, 9) != state.readBytes(5, 9)), "[-] State: the copies are not independent"
+		assert (str(copy.getBytes()) == str(xorBytes(bytearray(original), bytearray("\0"*5 + "copy" + "\0"*141 + "\x80" + "\0"*49)))), "[-] State: a write to the original leaked into a copy"
+
+	K = generate_simple_raw_material(16, 16, 1)
+	N = generate_simple_raw_material(16, 17, 2)
+	P = generate_simple_raw_material(700, 18, 3)
+	for newKeyak in [LakeKeyak, SeaKeyak]:
+		session = newKeyak()
+		session.StartEngine(K, N, False, stringStream(), False, False)
+		original = session.to_bytes()
+		fork = session.fork()
+		fork.Wrap(stringStream(P), stringStream(), stringStream("fork"), stringStream(), False, True)
+		assert (session.to_bytes() == original), "[-] %s: a write to a fork leaked into the original" % session.GetName()
+		forked = fork.to_bytes()
+		snapshot = session.snapshot()
+		session.Wrap(stringStream(P), stringStream(), stringStream("session"), stringStream(), False, False)
+		assert ((fork.to_bytes() == forked) and (snapshot.to_bytes() == original)), "[-] %s: a write to the original leaked into a fork" % session.GetName()
+
+		outputs = []
+		for i in xrange(2):
+			session.restore(snapshot)
+			assert (session.to_bytes() == original), "[-] %s: restore() did not restore the snapshot" % session.GetName()
+			(O, T) = (stringStream(), stringStream())
+			session.Wrap(stringStream(P), O, stringStream("restored"), T, False, True)
+			outputs.append((O.getvalue(), T.getvalue()))
+			assert (snapshot.to_bytes() == original), "[-] %s: a write to a restored session leaked into the snapshot" % session.GetName()
+		assert (outputs[0] == outputs[1]), "[-] %s: restoring the same snapshot twice gives different outputs" % session.GetName()
+	return True
+
+# Check that Keyak.wrap_many gives the same ciphertexts, tags and results as separate Wrap calls, for sessions
+# of several instances with messages and metadata of mixed lengths (including empty ones), and with a wrong tag
+def test_wrap_many():
+	K = generate_simple_raw_material(16, 13, 1)
+	instances = [LakeKeyak, LakeKeyak, RiverKeyak, SeaKeyak, LakeKeyak, OceanKeyak]
+	lengths = [(0, 0), (1, 0), (0, 17), (500, 3), (168, 300), (1000, 1000)]
+	P = [generate_simple_raw_material(Plen, i, 3) for (i, (Plen, Alen)) in enumerate(lengths)]
+	A = [generate_simple_raw_material(Alen, i, 4) for (i, (Plen, Alen)) in enumerate(lengths)]
+	for forgetFlag in [False, True]:
+		sessions = []
+		for i in xrange(len(instances)):
+			session = instances[i]()
+			session.StartEngine(K, generate_simple_raw_material(16, i, 2), False, stringStream(), False, False)
+			sessions.append(session)
+
+		for unwrapFlag in [False, True]:
+			if (unwrapFlag):
+				# Unwrap the ciphertexts wrapped above, with a wrong tag for one of the sessions
+				I = [C for (res, C, tag) in wrapped]
+				tags = [tag for (res, C, tag) in wrapped]
+				tags[3] = ("\0"*len(tags[3]))
+			else:
+				I = P
+				tags = [""]*len(sessions)
+
+			expected = []
+			for i in xrange(len(sessions)):
+				(O, T) = (stringStream(), stringStream(tags[i]))
+				res = sessions[i].fork().Wrap(stringStream(I[i]), O, stringStream(A[i]), T, unwrapFlag, forgetFlag)
+				expected.append((res, O.getvalue(), T.getvalue()))
+
+			O = [stringStream() for i in xrange(len(sessions))]
+			T = [stringStream(tag) for tag in tags]
+			res = Keyak.wrap_many([s.fork() for s in sessions], [stringStream(x) for x in I], O, [stringStream(a) for a in A], T, unwrapFlag, forgetFlag)
+			assert ([(res[i], O[i].getvalue(), T[i].getvalue()) for i in xrange(len(sessions))] == expected), ("[-] wrap_many() (unwrapFlag=%s, forgetFlag=%s) differs from separate Wrap() calls" % (unwrapFlag, forgetFlag))
+			if (unwrapFlag):
+				assert (res == [True, True, True, False, True, True]), "[-] wrap_many() did not report the wrong tag of its session only"
+				assert ([O[i].getvalue() for i in xrange(len(sessions)) if (i != 3)] == (P[:3] + P[4:])), "[-] wrap_many() did not unwrap the plaintexts"
+			else:
+				wrapped = expected
+	return True
+
+# Check that files round-trip through chunked containers, sequentially and on a process pool, and that wrong
+# keys, tampered chunks and truncated containers are rejected without output and without leaving workers behind
+def test_container():
+	K = generate_simple_raw_material(16, 19, 1)
+	directory = tempfile.mkdtemp()
+	try:
+		(plainPath, containerPath, outPath) = [os.path.join(directory, name) for name in ["plain", "container", "out"]]
+		chunkSize = 100
+		for (size, instance, processes) in [(0, LakeKeyak, 1), (1, RiverKeyak, 2), (chunkSize, SeaKeyak, 1), (3*chunkSize, LakeKeyak, 2), (1000 + 7, OceanKeyak, 2)]:
+			plaintext = generate_simple_raw_material(size, size, 2)
+			with open(plainPath, 'wb') as f:
+				f.write(plaintext)
+			container.encryptFile(plainPath, containerPath, K, instance, chunkSize, processes)
+			with open(containerPath, 'rb') as f:
+				data = f.read()
+			count = max((size + chunkSize - 1) // chunkSize, 1)
+			assert (len(data) == (container.HEADER_SIZE + size + count*container.TAG_SIZE)), "[-] Container: unexpected container size"
+			assert container.decryptFile(containerPath, outPath, K, processes), "[-] Container: decryption failed"
+			with open(outPath, 'rb') as f:
+				assert (f.read() == plaintext), "[-] Container: the decrypted file differs from the original"
+
+			# Wrong key, a flipped ciphertext or tag byte, the last chunk dropped and a cut in the middle of a chunk
+			corrupted = [(generate_simple_raw_material(16, 20, 1), data),
+						 (K, data[:container.HEADER_SIZE] + chr(ord(data[container.HEADER_SIZE]) ^ 1) + data[container.HEADER_SIZE+1:]),
+						 (K, data[:-1] + chr(ord(data[-1]) ^ 0x80)),
+						 (K, data[:-5])]
+			if (count > 1):
+				corrupted.append((K, data[:(len(data) - ((size - 1) % chunkSize) - 1 - container.TAG_SIZE)]))
+			for (key, bad) in corrupted:
+				with open(containerPath, 'wb') as f:
+					f.write(bad)
+				assert not(container.decryptFile(containerPath, outPath, key, processes)), "[-] Container: a corrupted container was accepted"
+				assert not(os.path.exists(outPath)), "[-] Container: output was left after a failed decryption"
+				assert (len(multiprocessing.active_children()) == 0), "[-] Container: workers were left running after a failed decryption"
+
+		with open(containerPath, 'wb') as f:
+			f.write("not a container")
+		rejected = False
+		try:
+			container.decryptFile(containerPath, outPath, K, 1)
+		except Exception:
+			rejected = True
+		assert rejected, "[-] Container: an input that is not a container was accepted"
+	finally:
+		shutil.rmtree(directory)
+	return True
+
+# Check that batches wrapped and unwrapped by a SessionService, submitted concurrently from a thread pool, match
+# direct Wrap calls, with messages in shared memory and inline, and that failed tags are reported per item
+def test_session_service():
+	K = generate_simple_raw_material(16, 21, 1)
+	service = SessionService(LakeKeyak, 2, 1024)
+	try:
+		clients = 4
+		sessions = []
+		for i in xrange(clients):
+			N = generate_simple_raw_material(16, i, 2)
+			assert (service.open(("wrap", i), K, N).get() == ("", True)), "[-] SessionService: open() failed"
+			service.open(("unwrap", i), K, N, unwrapFlag=True).get()
+			direct = LakeKeyak()
+			direct.StartEngine(K, N, False, stringStream(), False, False)
+			sessions.append(direct)
+
+		# Every client wraps a sequence of batches of its session, with one message too large for the shared memory
+		messages = [[(generate_simple_raw_material(Plen, i+Plen, 3), generate_simple_raw_material(i+5, Plen, 4)) for Plen in [10, 0, 300, 2000, 50]] for i in xrange(clients)]
+		def wrapMessages(i):
+			return [r.get() for (P, A) in messages[i] for r in service.submit([(("wrap", i), P, A)])]
+		clientPool = ThreadPool(clients)
+		wrapped = clientPool.map(wrapMessages, range(clients))
+		clientPool.close()
+		for i in xrange(clients):
+			expected = []
+			for (P, A) in messages[i]:
+				(O, T) = (stringStream(), stringStream())
+				res = sessions[i].Wrap(stringStream(P), O, stringStream(A), T, False, False)
+				expected.append((O.getvalue(), T.getvalue(), res))
+			assert ([(str(C), tag, res) for (C, tag, res) in wrapped[i]] == expected), "[-] SessionService: wrapping differs from direct Wrap() calls"
+
+		# A single batch unwrapping the first message of every client, with a wrong tag for client 1
+		batch = []
+		for i in xrange(clients):
+			(C, tag, res) = wrapped[i][0]
+			if (i == 1):
+				tag = ("\0"*len(tag))
+			batch.append((("unwrap", i), str(C), messages[i][0][1], tag))
+		results = [r.get() for r in service.submit(batch)]
+		assert ([res for (P, tag, res) in results] == [True, False, True, True]), "[-] SessionService: a failed tag was not reported for its item only"
+		assert ([str(results[i][0]) for i in xrange(clients)] == [messages[0][0][0], "", messages[2][0][0], messages[3][0][0]]), "[-] SessionService: unwrapping did not give the plaintexts"
+
+		rejected = False
+		try:
+			service.submit([(("unknown", 0), "message", "")])[0].get()
+		except Exception:
+			rejected = True
+		assert rejected, "[-] SessionService: a request for an unknown session succeeded"
+	finally:
+		service.shutdown()
+	return True
+
+# Check that records written by a RecordWriter are unwrapped by a RecordReader fed in arbitrary splits, on the
+# calling thread and offloaded to a thread pool, that a wrong tag fails the reader, and that records announced
+# larger than maxRecordSize fail it in order
+def test_records():
+	K = generate_simple_raw_material(16, 22, 1)
+	N = generate_simple_raw_material(16, 23, 2)
+	messages = [(generate_simple_raw_material(Plen, Plen, 3), generate_simple_raw_material(Alen, Alen, 4)) for (Plen, Alen) in [(0, 0), (5, 0), (0, 9), (300, 20), (1000, 1), (40, 40)]]
+	def session(unwrapFlag):
+		keyak = LakeKeyak()
+		keyak.StartEngine(K, N, False, stringStream(), unwrapFlag, False)
+		return keyak
+	# Offloaded records are delivered on the executor's threads
+	def waitFor(received, count):
+		deadline = (time.time() + 10)
+		while ((len(received) < count) and (time.time() < deadline)):
+			time.sleep(0.001)
+
+	records = []
+	writer = RecordWriter(session(False), records.append)
+	for (P, A) in messages:
+		writer.send(P, A)
+	assert (len(records) == len(messages)), "[-] RecordWriter: not all records were written"
+	data = "".join(records)
+
+	executor = ThreadPool(2)
+	try:
+		for (offloadThreshold, splits) in [(65536, [1]), (65536, [7, 1, FRAME_HEADER.size]), (100, [len(r) for r in records]), (100, [len(data)]), (65536, [3, 500])]:
+			received = []
+			reader = RecordReader(session(True), lambda A, P: received.append((P, A)), lambda A: received.append(("error", A)), executor=executor, offloadThreshold=offloadThreshold)
+			offset = 0
+			i = 0
+			while (offset < len(data)):
+				size = splits[i % len(splits)]
+				reader.feed(data[offset:offset+size])
+				offset += size
+				i += 1
+			waitFor(received, len(messages))
+			assert (received == messages), ("[-] RecordReader: records fed in splits of %r were not all unwrapped" % splits)
+
+		# A wrong tag in the fourth record fails the reader, the records after it are not delivered
+		end = sum(len(r) for r in records[:4])
+		corrupted = (data[:end-1] + chr(ord(data[end-1]) ^ 1) + data[end:])
+		received = []
+		reader = RecordReader(session(True), lambda A, P: received.append((P, A)), lambda A: received.append(("error", A)))
+		reader.feed(corrupted)
+		assert ((received == (messages[:3] + [("error", messages[3][1])])) and reader.failed), "[-] RecordReader: a wrong tag did not fail the reader"
+
+		# A record over maxRecordSize is rejected as soon as its header is received, after the records before it
+		for maxRecordSize in [320, 1000]:
+			received = []
+			reader = RecordReader(session(True), lambda A, P: received.append((P, A)), lambda A: received.append(("error", A)), executor=executor, offloadThreshold=100, maxRecordSize=maxRecordSize)
+			end = sum(len(r) for r in records[:4])
+			reader.feed(data[:end + FRAME_HEADER.size])
+			waitFor(received, 5)
+			assert (reader.rejected and (received == (messages[:4] + [("error", None)]))), ("[-] RecordReader: a record over %d bytes was not rejected" % maxRecordSize)
+			reader.feed(data[end + FRAME_HEADER.size:])
+			time.sleep(0.01)
+			assert ((len(received) == 5) and (len(reader.buffer) == 0)), "[-] RecordReader: input after a rejected record was not ignored"
+	finally:
+		executor.terminate()
+	return True
+
+# Check that sessions stored in a SessionSlab, used in interleaved order and across slab growth, give the same
+# output as Keyak objects, and that released slots cannot be used anymore
+def test_session_slab():
+	K = generate_simple_raw_material(16, 24, 1)
+	for newKeyak in [LakeKeyak, SeaKeyak]:
+		slab = SessionSlab(newKeyak, 2)
+		compact = [slab.new() for i in xrange(5)]
+		assert ((len(slab) == 5) and (slab.capacity() >= 5)), "[-] SessionSlab: unexpected size after growing"
+		objects = [newKeyak() for i in xrange(5)]
+		for i in xrange(5):
+			N = generate_simple_raw_material(16, i, 2)
+			(T, TT) = (stringStream(), stringStream())
+			assert (compact[i].StartEngine(K, N, True, T, False, False) == objects[i].StartEngine(K, N, True, TT, False, False)), "[-] SessionSlab: StartEngine failed"
+			assert (T.getvalue() == TT.getvalue()), "[-] SessionSlab: the StartEngine tag differs from a Keyak object"
+
+		for j in xrange(3):
+			for i in [3, 0, 4, 1, 2]:
+				P = generate_simple_raw_material(100*j + i, i, 3)
+				A = generate_simple_raw_material(j, i, 4)
+				(O, T) = (stringStream(), stringStream())
+				(OO, TT) = (stringStream(), stringStream())
+				res = compact[i].Wrap(stringStream(P), O, stringStream(A), T, False, (j == 1))
+				assert ((res, O.getvalue(), T.getvalue()) == (objects[i].Wrap(stringStream(P), OO, stringStream(A), TT, False, (j == 1)), OO.getvalue(), TT.getvalue())), "[-] SessionSlab: a slab session wraps differently"
+				out = bytearray(len(P))
+				tag = bytearray(16)
+				assert (compact[i].wrap_into(out, 0, P, A, tag, 0, False) == (len(P), True)), "[-] SessionSlab: wrap_into() failed"
+				(O, T) = (stringStream(), stringStream())
+				objects[i].Wrap(stringStream(P), O, stringStream(A), T, False, False)
+				assert ((str(out) == O.getvalue()) and (str(tag) == T.getvalue())), "[-] SessionSlab: wrap_into() on a slab session differs"
+		assert all((compact[i].to_bytes() == objects[i].to_bytes()) for i in xrange(5)), "[-] SessionSlab: a slab record differs from the serialized session"
+
+		# Released slots are zeroed and reused, and their handles raise
+		slot = compact[2].slot
+		compact[2].close()
+		rejected = False
+		try:
+			compact[2].Wrap(stringStream("message"), stringStream(), stringStream(""), stringStream(), False, False)
+		except Exception:
+			rejected = True
+		assert (rejected and (len(slab) == 4)), "[-] SessionSlab: a released session could still be used"
+		offset = (slot * slab.recordSize)
+		assert (slab.slab[offset:offset+slab.recordSize] == bytearray(slab.recordSize)), "[-] SessionSlab: a released record was not zeroed"
+		reused = slab.new()
+		assert ((reused.slot == slot) and (reused.to_bytes() == newKeyak().to_bytes())), "[-] SessionSlab: a reused slot does not hold a new session"
+	return True
+
+# Check that the statistics counters match the processed input, that disableStats() leaves no instance
+# attribute shadowing the class methods and that forks of an instrumented session are not instrumented
+def test_instrumentation():
+	K = generate_simple_raw_material(16, 25, 1)
+	N = generate_simple_raw_material(16, 25, 2)
+	for newKeyak in [LakeKeyak, OceanKeyak]:
+		reference = newKeyak()
+		session = newKeyak()
+		events = []
+		session.enableStats(lambda event, value: events.append((event, value)))
+		names = (session.motorist.engine._instrumented + session.motorist._instrumented)
+		(lengthP, lengthA) = (0, 0)
+		for keyak in [reference, session]:
+			keyak.StartEngine(K, N, False, stringStream(), False, True)
+		for (i, forgetFlag) in enumerate([True, False, False]):
+			P = generate_simple_raw_material(500*i, i, 3)
+			A = generate_simple_raw_material(1000 - 300*i, i, 4)
+			wrap_both(session, reference, P, A, False, forgetFlag)
+			(lengthP, lengthA) = ((lengthP + len(P)), (lengthA + len(A)))
+		stats = session.stats()
+		sparks = stats['sparks']
+		assert ((stats['bytesCrypted'] == lengthP) and (stats['bytesInjected'] == lengthA) and (stats['bytesInjectedCollective'] > 0)), "[-] Instrumentation: wrong byte counters"
+		assert (stats['permutations'] == (session.motorist.Pi * sum(sparks.values()))), "[-] Instrumentation: wrong permutation count"
+		assert (sum(stats['bytesPerSpark'].values()) == (sparks['crypt'] + sparks['metadata'])), "[-] Instrumentation: wrong bytesPerSpark histogram"
+		# A knot for StartEngine, then one per Wrap with several pistons or only for the forgetting Wrap
+		knots = (1 + (3 if (session.motorist.Pi > 1) else 1))
+		assert ((stats['knots'], stats['tags'], stats['tagFailures']) == (knots, 3, 0)), "[-] Instrumentation: wrong knot or tag counters"
+		assert (set(stats['motoristPhaseTime']) <= set(['ready', 'riding', 'failed'])), "[-] Instrumentation: wrong motorist phases"
+		assert ((len([e for e in events if (e[0] == 'spark')]) == sum(sparks.values())) and (events.count(('knot', None)) == knots) and (events.count(('tag', True)) == 3)), "[-] Instrumentation: wrong callback events"
+
+		# A fork is neither instrumented nor counted
+		other = session.fork()
+		assert ((other.stats() == None) and not any(((name in other.motorist.__dict__) or (name in other.motorist.engine.__dict__)) for name in names)), "[-] Instrumentation: a fork kept the instrumented methods"
+		before = (session.stats(), len(events))
+		wrap_both(other, reference.fork(), "message", "", False, False)
+		assert ((session.stats() == before[0]) and (len(events) == before[1])), "[-] Instrumentation: a fork updated the statistics"
+
+		# Once disabled, only the class methods remain and the callback is no longer called
+		session.disableStats()
+		assert ((session.stats() == None) and not any(((name in session.motorist.__dict__) or (name in session.motorist.engine.__dict__)) for name in names)), "[-] Instrumentation: disableStats() left instance attributes"
+		assert (session.motorist.Wrap.__func__ is type(session.motorist).Wrap.__func__), "[-] Instrumentation: Wrap() is still shadowed"
+		wrap_both(session, reference, "message", "", False, False)
+		assert (len(events) == before[1]), "[-] Instrumentation: the callback was called after disableStats()"
+
+		# Failed tag verifications are counted
+		(sender, receiver) = (newKeyak(), newKeyak())
+		sender.StartEngine(K, N, False, stringStream(), False, False)
+		receiver.StartEngine(K, N, False, stringStream(), True, False)
+		events = []
+		receiver.enableStats(lambda event, value: events.append((event, value)))
+		(C, T) = (stringStream(), stringStream())
+		sender.Wrap(stringStream("message"), C, stringStream(""), T, False, False)
+		T = chr(ord(T.getvalue()[0]) ^ 1) + T.getvalue()[1:]
+		assert not(receiver.Wrap(stringStream(C.getvalue()), stringStream(), stringStream(""), stringStream(T), True, False)), "[-] Instrumentation: a wrong tag was accepted"
+		assert (((receiver.stats()['tags'], receiver.stats()['tagFailures']) == (1, 1)) and (('tag', False) in events)), "[-] Instrumentation: a failed tag was not counted"
+	return True
+
+# Executor running every job right away on the calling thread
+class synchronousExecutor(object):
+	def apply_async(self, func, args, callback = None):
+		result = func(*args)
+		if (callback != None):
+			callback(result)
+		return
+
+# Executor failing every job, as if no session could be started on it
+class failingExecutor(object):
+	def apply_async(self, func, args, callback = None):
+		callback((args[2], None, None, "The executor is unavailable."))
+		return
+
+# Check that a SessionPool hands out sessions started for the nonces of its schedule, in order and each once,
+# that they match a direct StartEngine, that starvations are counted and that close() stops the pool
+def test_session_pool():
+	K = generate_simple_raw_material(16, 11, 1)
+	P = generate_simple_raw_material(100, 12, 2)
+	for executor in [synchronousExecutor(), None]:
+		pool = SessionPool(LakeKeyak(), K, counterNonces(0, 12), True, False, 4, 2, executor)
+		nonces = []
+		for i in xrange(10):
+			(session, N, T) = pool.get()
+			nonces.append(N)
+			direct = LakeKeyak()
+			TT = stringStream()
+			direct.StartEngine(K, N, True, TT, False, False)
+			assert (T == TT.getvalue()), "[-] SessionPool: the tag of StartEngine differs from a direct StartEngine"
+			(O, T) = (stringStream(), stringStream())
+			(OO, TT) = (stringStream(), stringStream())
+			session.Wrap(stringStream(P), O, stringStream(""), T, False, False)
+			direct.Wrap(stringStream(P), OO, stringStream(""), TT, False, False)
+			assert ((O.getvalue(), T.getvalue()) == (OO.getvalue(), TT.getvalue())), "[-] SessionPool: a pooled session wraps differently"
+		stats = pool.stats()
+		assert (stats['requests'] == 10), "[-] SessionPool: unexpected number of requests"
+		if (executor != None):
+			# Without starvations sessions are handed out in nonce order
+			assert ((nonces == list(itertools.islice(counterNonces(0, 12), 10))) and (stats['hits'] == 10)), "[-] SessionPool: sessions were not handed out in nonce order"
+		assert (len(set(nonces)) == 10), "[-] SessionPool: a nonce was used twice"
+		pool.close()
+		rejected = False
+		try:
+			pool.get()
+		except Exception:
+			rejected = True
+		assert (rejected and (len(pool) == 0)), "[-] SessionPool: a closed pool handed out a session"
+
+	# Sessions that could not be started are replaced by sessions started by get(), counted as starvations
+	pool = SessionPool(LakeKeyak(), K, counterNonces(0, 12), False, False, 2, 0, failingExecutor())
+	(session, N, T) = pool.get()
+	stats = pool.stats()
+	assert ((stats['starvations'], stats['hits'], stats['errors']) == (1, 0, 4)), "[-] SessionPool: unexpected statistics after a starvation"
+	assert ((N == counterNonces(2, 12).next()) and (session.motorist.phase == MotoristPhase.riding)), "[-] SessionPool: a starved get() did not start a session with the next nonce"
+
+	# The schedule runs out
+	pool = SessionPool(LakeKeyak(), K, counterNonces(254, 1), False, False, 4, 2, synchronousExecutor())
+	assert ([pool.get()[1] for i in xrange(2)] == ["\xfe", "\xff"]), "[-] SessionPool: the nonce schedule was not followed"
+	rejected = False
+	try:
+		pool.get()
+	except Exception:
+		rejected = True
+	assert rejected, "[-] SessionPool: a session was handed out after the nonce schedule ran out"
 	return True
 
 # Sanity test for all named instances of Keyak v2
@@ -304,5 +1115,53 @@ if(test_keccakf()):
 if(test_keccakp()):
 	print "[+] KeccakP sanity tests succeeded"	
 
+if(test_keccakp_backends()):
+	print "[+] KeccakP backend cross-checks succeeded"
+
+if(test_keccakp_batch_array()):
+	print "[+] KeccakP batch array tests succeeded"
+
+if(test_vector_engine()):
+	print "[+] Vectorized engine tests succeeded"
+
+if(test_keycache()):
+	print "[+] Key cache tests succeeded"
+
+if(test_wrap_into()):
+	print "[+] wrap_into/unwrap_into tests succeeded"
+
+if(test_serialization()):
+	print "[+] Serialization tests succeeded"
+
+if(test_scatter_gather()):
+	print "[+] Scatter-gather tests succeeded"
+
+if(test_keyak_stream()):
+	print "[+] KeyakStream tests succeeded"
+
+if(test_copy_on_write()):
+	print "[+] Copy-on-write tests succeeded"
+
+if(test_wrap_many()):
+	print "[+] wrap_many tests succeeded"
+
+if(test_session_pool()):
+	print "[+] Session pool tests succeeded"
+
+if(test_container()):
+	print "[+] Container tests succeeded"
+
+if(test_session_service()):
+	print "[+] Session service tests succeeded"
+
+if(test_records()):
+	print "[+] Record tests succeeded"
+
+if(test_session_slab()):
+	print "[+] Session slab tests succeeded"
+
+if(test_instrumentation()):
+	print "[+] Instrumentation tests succeeded"
+
 if(test_all_keyak()):
 	print "[+] Keyak sanity tests succeeded"
\ No newline at end of file
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Process-pool AEAD service
+#
+# SessionService runs a pool of worker processes owning long-lived Keyak sessions, keyed by session id.
+# Every session lives on a fixed worker (chosen from its id), and every worker handles its requests in
+# submission order, so the messages of a session are (un)wrapped in the order they were submitted.
+# Message and metadata bytes are passed through an anonymous shared memory region per worker (mapped
+# before the workers are forked) rather than pickled; only offsets, session ids and tags go through pipes.
+
+import mmap
+import threading
+from Queue import Queue
+from multiprocessing import Process, Pipe, cpu_count
+
+from keyak import *
+
+DEFAULT_BUFFER_SIZE = (1 << 20)
+
+# Result of an asynchronous request
+class Result(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        return
+
+    # Public methods
+    def ready(self):
+        return self.event.is_set()
+
+    # Wait for and return the value, raises an exception if the request failed
+    def get(self, timeout = None):
+        if not(self.event.wait(timeout)):
+            raise Exception("The request did not complete in time.")
+        if (self.error != None):
+            raise Exception(self.error)
+        return self.value
+
+    # 'Protected' methods
+    def _set(self, value):
+        self.value = value
+        self.event.set()
+        return
+
+    def _fail(self, error):
+        self.error = error
+        self.event.set()
+        return
+
+# Wrap an item of a batch in a worker, writing the output into responses at offset unless the item is inline.
+# Returns (output offset, output length or inline output, tag, result, error); when a tag does not verify nothing
+# is written and the output is empty.
+def _wrapItem(sessions, requests, responses, offset, forgetFlag, sid, inOffset, mLen, aLen, T, inline):
+    if (sid not in sessions):
+        return (None, None, None, None, "Unknown session %r." % (sid,))
+    (keyak, unwrapFlag) = sessions[sid]
+    if (inline != None):
+        data = inline
+        inOffset = 0
+    else:
+        data = requests
+    O = bufferStream()
+    Tstream = bufferStream(bytearray(T))
+    res = keyak.Wrap(bufferStream(data[inOffset:inOffset+mLen]), O, bufferStream(data[inOffset+mLen:inOffset+mLen+aLen]), Tstream, unwrapFlag, forgetFlag)
+    if (inline != None):
+        return (None, O.getvalue(), Tstream.getvalue(), res, None)
+    if not(res):
+        return (offset, 0, Tstream.getvalue(), False, None)
+    responses[offset:offset+mLen] = O.getvalue()
+    return (offset, mLen, Tstream.getvalue(), res, None)
+
+# Worker process main loop
+def _serve(conn, requests, responses, keyakClass):
+    sessions = {}
+    while True:
+        job = conn.recv()
+        try:
+            if (job[0] == 'stop'):
+                break
+            elif (job[0] == 'open'):
+                (op, sid, K, N, tagFlag, T, unwrapFlag, forgetFlag) = job
+                keyak = keyakClass()
+                Tstream = bufferStream(bytearray(T))
+                res = keyak.StartEngine(K, N, tagFlag, Tstream, unwrapFlag, forgetFlag)
+                sessions[sid] = (keyak, unwrapFlag)
+                conn.send(('ok', (Tstream.getvalue(), res)))
+            elif (job[0] == 'close'):
+                sessions.pop(job[1], None)
+                conn.send(('ok', None))
+            elif (job[0] == 'wrap'):
+                # Items are (session id, offset, message length, metadata length, tag, inline data),
+                # results are (output offset, output length or inline output, tag, result, error)
+                (op, forgetFlag, items) = job
+                results = []
+                offset = 0
+                for item in items:
+                    # Items fail one by one, so that the outputs of the other sessions are not lost
+                    try:
+                        result = _wrapItem(sessions, requests, responses, offset, forgetFlag, *item)
+                    except Exception as e:
+                        result = (None, None, None, None, str(e))
+                    if (result[0] != None):
+                        offset += result[1]
+                    results.append(result)
+                conn.send(('ok', results))
+        except Exception as e:
+            conn.send(('error', str(e)))
+    conn.close()
+    return
+
+# Handle of a worker process, jobs are sent to it one at a time by a dispatcher thread
+class _Worker(object):
+    def __init__(self, keyakClass, bufferSize):
+        self.bufferSize = bufferSize
+        self.requests = mmap.mmap(-1, bufferSize)
+        self.responses = mmap.mmap(-1, bufferSize)
+        (self.conn, child) = Pipe()
+        self.process = Process(target=_serve, args=(child, self.requests, self.responses, keyakClass))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+        self.jobs = Queue()
+        self.thread = threading.Thread(target=self._dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+    def _dispatch(self):
+        while True:
+            (job, results) = self.jobs.get()
+            if (job == None):
+                self.conn.send(('stop',))
+                break
+            try:
+                if (job[0] == 'wrap'):
+                    self._wrap(job, results)
+                else:
+                    self.conn.send(job)
+                    (status, value) = self.conn.recv()
+                    if (status == 'ok'):
+                        results[0]._set(value)
+                    else:
+                        results[0]._fail(value)
+            except Exception as e:
+                for result in results:
+                    result._fail(str(e))
+        return
+
+    # Copy the batch into the request region (items that do not fit are sent inline) and collect the outputs
+    def _wrap(self, job, results):
+        (op, forgetFlag, batch) = job
+        items = []
+        offset = 0
+        for (sid, message, metadata, T) in batch:
+            size = (len(message) + len(metadata))
+            if ((offset + size) <= self.bufferSize):
+                self.requests[offset:offset+size] = (message + metadata)
+                items.append((sid, offset, len(message), len(metadata), T, None))
+                offset += size
+            else:
+                items.append((sid, 0, len(message), len(metadata), T, message + metadata))
+
+        self.conn.send(('wrap', forgetFlag, items))
+        (status, value) = self.conn.recv()
+        if (status != 'ok'):
+            for result in results:
+                result._fail(value)
+            return
+
+        for (result, (outOffset, out, T, res, error)) in zip(results, value):
+            if (error != None):
+                result._fail(error)
+                continue
+            if (outOffset != None):
+                out = self.responses[outOffset:outOffset+out]
+            result._set((out, T, res))
+        return
+
+# SessionService class
+class SessionService(object):
+    def __init__(self, keyakClass = LakeKeyak, processes = None, bufferSize = DEFAULT_BUFFER_SIZE):
+        if (processes == None):
+            processes = cpu_count()
+        self.workers = [_Worker(keyakClass, bufferSize) for i in xrange(processes)]
+        return
+
+    # Public methods
+    # Start a session with the given id on its worker. The result's value is (T, res) as for Keyak.StartEngine().
+    def open(self, sid, K, N, tagFlag = False, T = "", unwrapFlag = False, forgetFlag = False):
+        return self._submit(self._workerOf(sid), ('open', sid, K, N, tagFlag, T, unwrapFlag, forgetFlag))
+
+    # Drop the session with the given id
+    def close(self, sid):
+        return self._submit(self._workerOf(sid), ('close', sid))
+
+    # Submit a batch of (session id, message, metadata) tuples, with an additional tag for sessions opened with
+    # unwrapFlag set. Returns one result per tuple, whose value is (output, tag, res) as for Keyak.Wrap().
+    def submit(self, batch, forgetFlag = False):
+        results = [Result() for item in batch]
+        perWorker = {}
+        for (item, result) in zip(batch, results):
+            if (len(item) == 3):
+                item = (item + ("",))
+            worker = self._workerOf(item[0])
+            perWorker.setdefault(worker, ([], []))
+            perWorker[worker][0].append(item)
+            perWorker[worker][1].append(result)
+
+        for worker in perWorker:
+            (items, workerResults) = perWorker[worker]
+            worker.jobs.put((('wrap', forgetFlag, items), workerResults))
+        return results
+
+    # Stop all workers after their pending requests
+    def shutdown(self):
+        for worker in self.workers:
+            worker.jobs.put((None, None))
+        for worker in self.workers:
+            worker.thread.join()
+            worker.process.join()
+        return
+
+    # 'Protected' methods
+    def _workerOf(self, sid):
+        return self.workers[hash(sid) % len(self.workers)]
+
+    def _submit(self, worker, job):
+        result = Result()
+        worker.jobs.put((job, [result]))
+        return result
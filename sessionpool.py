@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+# Pool of sessions started ahead of demand, for nonces known in advance (e.g. counter-based nonces)
+#
+# A SessionPool takes the nonces of a schedule in order and runs StartEngine for them on an executor (any
+# object with apply_async(func, args, callback=...), a single-thread multiprocessing.pool.ThreadPool by
+# default), so that get() hands out a session in the riding phase by popping it from a deque. Whenever the
+# number of sessions ready or being started drops to lowWater, new ones are started until there are depth
+# of them. When no session is ready, get() waits for the next one being started, or starts one itself with
+# the next nonce of the schedule if there is none; both are counted as a starvation. Sessions are thus
+# handed out in nonce order except around starvations.
+#
+# Sessions are passed back from the executor serialized (see Keyak.to_bytes()), so that a process pool can
+# be used as well. With the default thread the sessions are started while the GIL is released, e.g.
+# while the server waits for I/O, rather than in parallel with other Python code.
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import threading
+
+from keyak import *
+
+DEFAULT_DEPTH = 16
+
+# Nonces of size bytes holding a big-endian counter from start, after a fixed prefix
+def counterNonces(start = 0, size = 16, prefix = ""):
+    counter = start
+    while True:
+        if (counter >= (1 << (8*size))):
+            return
+        yield prefix + ("%0*x" % (2*size, counter)).decode('hex')
+        counter += 1
+
+# Start a session of the instance with parameters (b, nr, Pi, c, tau), returns (session, N, tag)
+def _startSession(parameters, K, N, tagFlag, forgetFlag):
+    keyak = Keyak.new(*parameters)
+    T = bufferStream()
+    keyak.StartEngine(K, N, tagFlag, T, False, forgetFlag)
+    return (keyak, N, T.getvalue())
+
+# Start a session on an executor, returns (N, serialized session, tag, error)
+def _startSerializedSession(parameters, K, N, tagFlag, forgetFlag):
+    try:
+        (keyak, N, T) = _startSession(parameters, K, N, tagFlag, forgetFlag)
+        return (N, str(keyak.to_bytes()), T, None)
+    except Exception as e:
+        return (N, None, None, str(e))
+
+# SessionPool class
+# Sessions of the instance of keyak (e.g. LakeKeyak()) under key K, for the nonces of the iterable nonces
+class SessionPool(object):
+    def __init__(self, keyak, K, nonces, tagFlag = False, forgetFlag = False, depth = DEFAULT_DEPTH, lowWater = None, executor = None):
+        if (depth < 1):
+            raise Exception("The depth must be at least 1.")
+        if (lowWater == None):
+            lowWater = (depth / 2)
+        if not(0 <= lowWater < depth):
+            raise Exception("The refill watermark must be below the depth.")
+        self.parameters = (keyak.b, keyak.nr, keyak.Pi, keyak.c, keyak.tau)
+        self.K = K
+        self.nonces = iter(nonces)
+        self.tagFlag = tagFlag
+        self.forgetFlag = forgetFlag
+        self.depth = depth
+        self.lowWater = lowWater
+
+        self.ownsExecutor = (executor == None)
+        if (executor == None):
+            executor = ThreadPool(1)
+        self.executor = executor
+
+        # Ready sessions as (session, N, T) and number of sessions being started
+        self.ready = deque()
+        self.inFlight = 0
+        self.exhausted = False
+        self.closed = False
+        self.hits = 0
+        self.starvations = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.started = threading.Condition(self.lock)
+
+        with self.lock:
+            nonces = self._Refill()
+        self._Submit(nonces)
+        return
+
+    # Public methods
+    # Get a session in the riding phase, as (session, N, T) with its nonce N and the tag T of StartEngine
+    # ("" without tagFlag)
+    def get(self):
+        item = None
+        with self.lock:
+            if (self.closed):
+                raise Exception("The session pool is closed.")
+            if (len(self.ready) > 0):
+                self.hits += 1
+                (item, nonces) = self._Pop()
+            else:
+                self.starvations += 1
+                while ((len(self.ready) == 0) and (self.inFlight > 0) and not(self.closed)):
+                    self.started.wait()
+                if (self.closed):
+                    raise Exception("The session pool is closed.")
+                if (len(self.ready) > 0):
+                    (item, nonces) = self._Pop()
+                else:
+                    N = self._NextNonce()
+                    if (N == None):
+                        raise Exception("The nonce schedule is exhausted.")
+                    nonces = self._Refill()
+        self._Submit(nonces)
+
+        if (item == None):
+            item = _startSession(self.parameters, self.K, N, self.tagFlag, self.forgetFlag)
+        return item
+
+    # Stop starting sessions and drop the ready ones
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.clear()
+            self.started.notify_all()
+        if (self.ownsExecutor):
+            self.executor.terminate()
+        return
+
+    def stats(self):
+        with self.lock:
+            requests = (self.hits + self.starvations)
+            if (requests > 0):
+                hitRate = (self.hits / float(requests))
+            else:
+                hitRate = None
+            return {'hits': self.hits, 'starvations': self.starvations, 'requests': requests, 'hitRate': hitRate, 'ready': len(self.ready),
+                    'inFlight': self.inFlight, 'errors': self.errors, 'depth': self.depth, 'lowWater': self.lowWater}
+
+    # Number of ready sessions
+    def __len__(self):
+        return len(self.ready)
+
+    # 'Protected' methods
+    # Pop the next ready session, called with the lock held. Returns (session, nonces to pass to _Submit()).
+    def _Pop(self):
+        item = self.ready.popleft()
+        nonces = []
+        if ((len(self.ready) + self.inFlight) <= self.lowWater):
+            nonces = self._Refill()
+        return (item, nonces)
+
+    # Reserve the nonces of the sessions to start until depth of them are ready or being started, called with the
+    # lock held. The sessions are started by _Submit() once the lock is released, as executors may run the
+    # callback (which takes the lock) on the calling thread.
+    def _Refill(self):
+        nonces = []
+        while (not(self.closed) and ((len(self.ready) + self.inFlight + len(nonces)) < self.depth)):
+            N = self._NextNonce()
+            if (N == None):
+                break
+            nonces.append(N)
+        self.inFlight += len(nonces)
+        return nonces
+
+    # Start sessions for the nonces reserved by _Refill(), called without the lock held
+    def _Submit(self, nonces):
+        for N in nonces:
+            try:
+                self.executor.apply_async(_startSerializedSession, (self.parameters, self.K, N, self.tagFlag, self.forgetFlag), callback=self._Started)
+            except Exception as e:
+                # E.g. the executor has been terminated by close() in the meantime
+                self._Started((N, None, None, str(e)))
+        return
+
+    def _NextNonce(self):
+        if (self.exhausted):
+            return None
+        try:
+            return next(self.nonces)
+        except StopIteration:
+            self.exhausted = True
+            return None
+
+    def _Started(self, result):
+        (N, serialized, T, error) = result
+        item = None
+        if (error == None):
+            try:
+                item = (Keyak.from_bytes(serialized), N, T)
+            except Exception:
+                pass
+        with self.lock:
+            self.inFlight -= 1
+            if ((item == None) and not(self.closed)):
+                self.errors += 1
+            elif not(self.closed):
+                self.ready.append(item)
+            self.started.notify_all()
+        return
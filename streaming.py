@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Keyak v2 implementation by Jos Wetzels and Wouter Bokslag
+# hereby denoted as "the implementer".
+
+# Based on Keccak Python and Keyak v2 C++ implementations
+# by the Keccak, Keyak and Ketje Teams, namely, Guido Bertoni,
+# Joan Daemen, Michaël Peeters, Gilles Van Assche and Ronny Van Keer
+#
+# For more information, feedback or questions, please refer to:
+# http://keyak.noekeon.org/
+# http://keccak.noekeon.org/
+# http://ketje.noekeon.org/
+
+from tempfile import TemporaryFile
+
+from utils import *
+from motorist import *
+
+# Default size of the chunks read from file-like objects
+DEFAULT_CHUNK_SIZE = 65536
+
+# Policies for releasing plaintext before the tag has been verified (Pre-PEP 435 compatible 'enum' type)
+# spool: plaintext is written to a temporary file and only copied to the output once finalize() has
+#        verified the tag, on failure the temporary file is discarded and nothing is released
+# trusted: plaintext is written to the output as soon as it is decrypted, the caller trusts the
+#          ciphertext or must itself discard everything written so far when finalize() returns False
+class UnverifiedPolicy:
+    spool, trusted = range(2)
+
+# KeyakStream class
+# Incrementally wraps (or unwraps) a single message on a Keyak session in the riding phase,
+# using constant memory. Metadata A (string, stream or sequence of buffers) must be known when the message starts.
+# Data is fed with update(), output is written to the file-like object out, and finalize()
+# produces the tag (wrapping) or verifies it (unwrapping).
+class KeyakStream(object):
+    def __init__(self, keyak, out, A, unwrapFlag, forgetFlag, policy = UnverifiedPolicy.spool):
+        self.motorist = keyak.motorist
+        self.engine = keyak.motorist.engine
+        self.out = out
+        if (isinstance(A, (str, bytearray))):
+            A = bufferStream(A)
+        self.A = asStream(A)
+        self.unwrapFlag = unwrapFlag
+        self.forgetFlag = forgetFlag
+        self.policy = policy
+
+        # A Crypt call consumes at most Rs bytes per piston
+        self.blockSize = (self.motorist.Pi * self.motorist.Pistons[0].Rs)
+        self.buffer = bytearray()
+        self.finalized = False
+
+        if (unwrapFlag and (policy == UnverifiedPolicy.spool)):
+            self.sink = TemporaryFile()
+        else:
+            self.sink = out
+        return
+
+    # Public methods
+    # Process data, writing the output of all complete blocks
+    def update(self, data):
+        if (self.finalized):
+            raise Exception("KeyakStream.update() cannot be called after finalize().")
+        if (self.motorist.phase != MotoristPhase.riding):
+            raise Exception("The phase must be riding to call KeyakStream.update().")
+
+        self.buffer += data
+        # Only crypt a block when more input follows it, as the engine needs to know whether the message continues
+        if (len(self.buffer) > self.blockSize):
+            I = bufferStream(self.buffer)
+            O = bufferStream()
+            while ((len(self.buffer) - I.tell()) > self.blockSize):
+                self.engine.Crypt(I, O, self.unwrapFlag)
+                self.engine.Inject(self.A)
+            del self.buffer[:I.tell()]
+            self.sink.write(O.getvalue())
+        return
+
+    # Finish the message. When wrapping, returns the tag. When unwrapping, verifies the tag T (string)
+    # and returns whether it is correct.
+    def finalize(self, T = None):
+        if (self.finalized):
+            raise Exception("KeyakStream.finalize() can only be called once.")
+        self.finalized = True
+
+        O = bufferStream()
+        if (self.unwrapFlag):
+            Tstream = bufferStream(T)
+        else:
+            Tstream = bufferStream()
+
+        res = self.motorist.Wrap(bufferStream(self.buffer), O, self.A, Tstream, self.unwrapFlag, self.forgetFlag)
+        self.buffer = bytearray()
+
+        if not(self.unwrapFlag):
+            self.sink.write(O.getvalue())
+            return Tstream.getvalue()
+
+        if (self.sink is self.out):
+            if (res):
+                self.out.write(O.getvalue())
+            return res
+
+        # Release spooled plaintext only once the tag has been verified
+        if (res):
+            self.sink.write(O.getvalue())
+            self.sink.seek(0, 0)
+            chunk = self.sink.read(DEFAULT_CHUNK_SIZE)
+            while (chunk != ''):
+                self.out.write(chunk)
+                chunk = self.sink.read(DEFAULT_CHUNK_SIZE)
+        self.sink.close()
+        return res
+
+# Wrap everything read from the file-like object fin to fout in chunks of chunkSize bytes, returns the tag
+def wrapFile(keyak, fin, fout, A, forgetFlag, chunkSize = DEFAULT_CHUNK_SIZE):
+    stream = KeyakStream(keyak, fout, A, False, forgetFlag)
+    chunk = fin.read(chunkSize)
+    while (len(chunk) > 0):
+        stream.update(chunk)
+        chunk = fin.read(chunkSize)
+    return stream.finalize()
+
+# Unwrap everything read from the file-like object fin to fout in chunks of chunkSize bytes,
+# returns whether the tag T is correct. See UnverifiedPolicy for when plaintext is written to fout.
+def unwrapFile(keyak, fin, fout, A, T, forgetFlag, policy = UnverifiedPolicy.spool, chunkSize = DEFAULT_CHUNK_SIZE):
+    stream = KeyakStream(keyak, fout, A, True, forgetFlag, policy)
+    chunk = fin.read(chunkSize)
+    while (len(chunk) > 0):
+        stream.update(chunk)
+        chunk = fin.read(chunkSize)
+    return stream.finalize(T)
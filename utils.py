@@ -12,6 +12,7 @@
 # http://ketje.noekeon.org/
 
 from StringIO import StringIO
+from binascii import hexlify, unhexlify
 
 class stringStream(StringIO):
 	# Peek (extract byte without advancing position, return None if no more stream is available)
@@ -48,9 +49,242 @@ class stringStream(StringIO):
 		self.write(s)
 		return
 
+	# Pop up to n bytes (all remaining bytes if n is None) as a bytearray
+	def getBytes(self, n = None):
+		if (n == None):
+			return bytearray(self.read())
+		return bytearray(self.read(max(n, 0)))
+
+	# Push a string of bytes (str, bytearray or memoryview)
+	def putBytes(self, b):
+		self.write(str(b))
+		return
+
+# Cursor over a bytes-like buffer (bytearray, memoryview or str) without copying it.
+# Reads take slices of the buffer starting at the cursor; writes go into the buffer at the
+# cursor, so a preallocated bytearray (or writable memoryview) can be used as output.
+# Bytearrays grow when written past their end, other buffers raise an exception.
+# Supports the same interface as stringStream, which stays available as a compatibility adapter.
+class bufferStream(object):
+	def __init__(self, buf = None):
+		# Buffers passed in by the caller are never resized by erase()
+		self.owned = (buf == None)
+		if (buf == None):
+			buf = bytearray()
+		elif (isinstance(buf, str)):
+			buf = memoryview(buf)
+		self.buf = buf
+		self.pos = 0
+		# Number of valid bytes (initial contents plus anything written after them)
+		self.size = len(buf)
+		# Indexing bytearrays yields integers, indexing memoryviews yields characters
+		self.indexesInts = isinstance(buf, bytearray)
+		return
+
+	# Peek (extract byte without advancing position, return None if no more stream is available)
+	def peek(self):
+		if (self.pos >= self.size):
+			return None
+		if (self.indexesInts):
+			return self.buf[self.pos]
+		return ord(self.buf[self.pos])
+
+	# Pop a single byte (as integer representation)
+	def get(self):
+		b = self.peek()
+		self.pos += 1
+		return b
+
+	# Push a single byte (as integer representation)
+	def put(self, b):
+		self.putBytes(bytearray([b]))
+		return
+
+	# Pop up to n bytes (all remaining bytes if n is None) as a memoryview slice of the buffer, without copying
+	# them. A bytearray cannot be resized for as long as slices of it are referenced.
+	def getBytes(self, n = None):
+		if (n == None):
+			end = self.size
+		else:
+			end = min(self.pos + max(n, 0), self.size)
+		if (self.indexesInts):
+			b = memoryview(self.buf)[self.pos:end]
+		else:
+			b = self.buf[self.pos:end]
+		self.pos = end
+		return b
+
+	# Push a string of bytes (str, bytearray or memoryview)
+	def putBytes(self, b):
+		end = (self.pos + len(b))
+		if ((end > len(self.buf)) and not(isinstance(self.buf, bytearray))):
+			raise Exception("The output buffer is too small.")
+		self.buf[self.pos:end] = b
+		self.pos = end
+		self.size = max(self.size, end)
+		return
+
+	# Erase buffered contents (caller-provided writable buffers are zeroed in place)
+	def erase(self):
+		if (self.owned):
+			del self.buf[:]
+		elif (isinstance(self.buf, bytearray) or not(self.buf.readonly)):
+			self.buf[0:self.size] = bytearray(self.size)
+		self.size = 0
+		self.pos = 0
+		return
+
+	# Set buffered contents
+	def setvalue(self, s):
+		self.erase()
+		self.putBytes(s)
+		return
+
+	# Get buffered contents (as a string)
+	def getvalue(self):
+		return str(bytearray(self.buf[0:self.size]))
+
+	def seek(self, pos, mode = 0):
+		if (mode == 1):
+			pos += self.pos
+		elif (mode == 2):
+			pos += self.size
+		self.pos = pos
+		return
+
+	def tell(self):
+		return self.pos
+
+# Cursor over a sequence of buffers (each as accepted by bufferStream) read or written as one stream,
+# e.g. a message built from header, routing and body fragments, without concatenating them.
+# Reads that cross a buffer boundary join the pieces of that read only; writes fill every buffer up
+# to its length before moving on to the next one, only the last buffer grows if it is a bytearray.
+class bufferListStream(object):
+	def __init__(self, buffers):
+		self.streams = [bufferStream(buf) for buf in buffers]
+		if (len(self.streams) == 0):
+			self.streams = [bufferStream()]
+		self.index = 0
+		# Stream position of the start of the current buffer
+		self.offset = 0
+		return
+
+	# Peek (extract byte without advancing position, return None if no more stream is available)
+	def peek(self):
+		self._Skip()
+		return self.streams[self.index].peek()
+
+	# Pop a single byte (as integer representation)
+	def get(self):
+		self._Skip()
+		return self.streams[self.index].get()
+
+	# Push a single byte (as integer representation)
+	def put(self, b):
+		self.putBytes(bytearray([b]))
+		return
+
+	# Pop up to n bytes (all remaining bytes if n is None), as a memoryview (see bufferStream.getBytes()) when
+	# they are in a single buffer and as a bytearray otherwise
+	def getBytes(self, n = None):
+		self._Skip()
+		b = self.streams[self.index].getBytes(n)
+		while (((n == None) or (len(b) < n)) and (self.index < (len(self.streams) - 1))):
+			self._Next()
+			if (isinstance(b, memoryview)):
+				b = bytearray(b)
+			if (n == None):
+				b += self.streams[self.index].getBytes()
+			else:
+				b += self.streams[self.index].getBytes(n - len(b))
+		return b
+
+	# Push a string of bytes (str, bytearray or memoryview), spilling over into the next buffers
+	def putBytes(self, b):
+		written = 0
+		while True:
+			stream = self.streams[self.index]
+			if (self.index == (len(self.streams) - 1)):
+				stream.putBytes(b[written:])
+				return
+			n = min(len(b) - written, len(stream.buf) - stream.tell())
+			stream.putBytes(b[written:written+n])
+			written += n
+			if (written == len(b)):
+				return
+			self._Next()
+
+	# Erase buffered contents (caller-provided writable buffers are zeroed in place)
+	def erase(self):
+		for stream in self.streams:
+			stream.erase()
+		self.index = 0
+		self.offset = 0
+		return
+
+	# Set buffered contents
+	def setvalue(self, s):
+		self.erase()
+		self.putBytes(s)
+		return
+
+	# Get buffered contents of all buffers (as a string)
+	def getvalue(self):
+		return "".join(stream.getvalue() for stream in self.streams)
+
+	def seek(self, pos, mode = 0):
+		if (mode == 1):
+			pos += self.tell()
+		elif (mode == 2):
+			pos += sum(stream.size for stream in self.streams)
+		self.index = 0
+		self.offset = 0
+		for stream in self.streams:
+			stream.seek(0, 0)
+		while ((pos - self.offset) > self.streams[self.index].size) and (self.index < (len(self.streams) - 1)):
+			self._Next()
+		self.streams[self.index].seek(pos - self.offset, 0)
+		return
+
+	def tell(self):
+		return (self.offset + self.streams[self.index].tell())
+
+	# 'Protected' methods
+	# Move to the next buffer
+	def _Next(self):
+		self.offset += self.streams[self.index].size
+		self.index += 1
+		self.streams[self.index].seek(0, 0)
+		return
+
+	# Move past exhausted buffers
+	def _Skip(self):
+		while ((self.streams[self.index].peek() == None) and (self.index < (len(self.streams) - 1))):
+			self._Next()
+		return
+
+# Get a stream for a stream or for a sequence (list or tuple) of buffers, see bufferListStream
+def asStream(X):
+	if (isinstance(X, (list, tuple))):
+		return bufferListStream(X)
+	return X
+
 def hasMore(I):
 	return (I.peek() != None)
 
+# XOR two byte strings of equal length into a new bytearray, processing all bytes at once as big integers
+def xorBytes(a, b):
+	n = len(a)
+	if (n == 0):
+		return bytearray()
+	return bytearray(unhexlify('%0*x' % (2*n, int(hexlify(a), 16) ^ int(hexlify(b), 16))))
+
+# Shallow copy of an object with a __dict__, without the overhead of copy.copy()
+def shallowCopy(obj):
+	other = obj.__class__.__new__(obj.__class__)
+	other.__dict__.update(obj.__dict__)
+	return other
+
 def enc8(x):
 	if (x > 255):
 		raise Exception("The integer %d cannot be encoded on 8 bits." % x)